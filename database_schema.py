@@ -0,0 +1,268 @@
+import argparse
+import json
+import sys
+import psycopg2
+# Importar funciones generales
+from utils_tools import print_log
+from hash_utils import hash_key
+# Importar funciones para DB
+from database_utils import (
+    get_connection,
+    check_price_constraint,
+    create_statement_tables,
+    create_msi_plan_tables,
+    create_checkpoint_table,
+    create_ledger_tables
+)
+
+# ======= TABLAS =======
+
+# Tablas de la ingesta: columna -> definición (en orden de creación por llaves foráneas).
+# migrate crea la tabla si no existe y agrega las columnas que le falten.
+TABLES = {
+    "payment_type": {
+        "id_payment_type": "SERIAL PRIMARY KEY",
+        "payment_type": "VARCHAR(50)",
+    },
+    "store": {
+        "id_store": "SERIAL PRIMARY KEY",
+        "store_name": "VARCHAR(100) UNIQUE",
+        "store_url": "VARCHAR(255)",
+        "status": "BOOLEAN",
+    },
+    "provider": {
+        "id_provider": "SERIAL PRIMARY KEY",
+        "id_store": "INTEGER REFERENCES store",
+        "provider_url": "VARCHAR(500)",
+        "is_active": "BOOLEAN",
+    },
+    "product": {
+        "id_product": "SERIAL PRIMARY KEY",
+        "product_name": "VARCHAR(500)",
+        "description": "TEXT",
+        "image_url": "VARCHAR(1000)",
+        "brand": "VARCHAR(100)",
+        "category": "VARCHAR(100)",
+    },
+    "purchase": {
+        "id_purchase": "SERIAL PRIMARY KEY",
+        "id_provider": "INTEGER REFERENCES provider",
+        "id_payment_type": "INTEGER REFERENCES payment_type",
+        "total": "NUMERIC(12,2)",
+        "tax": "NUMERIC(12,2)",
+        "ieps": "NUMERIC(12,2)",
+        "purchase_date": "DATE",
+        "delivery_date": "DATE",
+        "exchange_rate": "NUMERIC(10,4)",
+        "shipping_cost": "NUMERIC(12,2)",
+        "discount": "NUMERIC(12,2)",
+    },
+    "operation": {
+        "id_operation": "SERIAL PRIMARY KEY",
+        "id_purchase": "INTEGER REFERENCES purchase",
+        "id_product": "INTEGER REFERENCES product",
+        "quantity": "INTEGER",
+        "unit_price": "NUMERIC(12,2)",
+        "unit_price_usd": "NUMERIC(12,2)",
+        "discount_percentage": "NUMERIC(8,4)",
+        "pieces_per_unit": "INTEGER",
+        "final_cost": "NUMERIC(12,2)",
+        "product_url": "VARCHAR(500)",
+    },
+    "price": {
+        "id_price": "SERIAL PRIMARY KEY",
+        "id_product": "INTEGER REFERENCES product",
+        "price": "NUMERIC(12,2)",
+        "offer_price": "NUMERIC(12,2)",
+        "start_date": "DATE",
+        "end_date": "DATE",
+    },
+}
+
+# Columnas que la ingesta deja en NULL: en esquemas anteriores pueden tener
+# NOT NULL/DEFAULT (provider.is_active queda NULL hasta verify_pending_providers)
+NULLABLE_COLUMNS = {
+    "provider": ["is_active"],
+}
+
+# Formas de pago que la ingesta busca por nombre (get_id_payment_type)
+PAYMENT_TYPES = ["Efectivo", "Tarjeta de Crédito"]
+
+# ======= ÍNDICES =======
+
+# nombre -> (tabla, columnas, único, condición). Cada uno cubre una consulta de HOT_QUERIES.
+INDEXES = {
+    # get_or_create_provider / load_providers
+    "provider_store_url_uq": ("provider", "id_store, provider_url", True, None),
+    # verify_pending_providers
+    "provider_unverified_idx": ("provider", "id_provider", False, "is_active IS NULL"),
+    # load_product_index (productos del archivo por nombre); un producto por nombre
+    "product_name_uq": ("product", "product_name", True, None),
+    # load_product_index (llaves de operación por producto)
+    "operation_product_key_idx": ("operation", "id_product, quantity, unit_price", False, None),
+    # reconcile_charges.load_purchases (rango de fechas)
+    "purchase_date_idx": ("purchase", "purchase_date", False, None),
+    # apply_prices: una sola fila vigente por producto
+    "price_open_uq": ("price", "id_product", True, "end_date IS NULL"),
+}
+
+# ======= CONSULTAS CRÍTICAS =======
+
+# nombre -> (consulta, parámetros de ejemplo); mismas formas que usa la ingesta
+HOT_QUERIES = {
+    "product_by_name": (
+        "SELECT product_name, id_product FROM product WHERE product_name = ANY(%s)",
+        (["-"],)
+    ),
+    "operation_keys": (
+        """
+            SELECT o.id_product, o.quantity, o.unit_price, p.purchase_date
+            FROM operation o
+            JOIN purchase p ON o.id_purchase = p.id_purchase
+            WHERE o.id_product = ANY(%s)
+        """,
+        ([0],)
+    ),
+    "provider_by_store_url": (
+        "SELECT id_provider FROM provider WHERE id_store = %s AND provider_url = %s",
+        (0, "-")
+    ),
+    "unverified_providers": (
+        "SELECT id_provider, provider_url FROM provider WHERE is_active IS NULL ORDER BY id_provider",
+        None
+    ),
+    "open_price": (
+        "SELECT id_price FROM price WHERE id_product = %s AND end_date IS NULL",
+        (0,)
+    ),
+    "purchases_by_date": (
+        "SELECT id_purchase, total FROM purchase WHERE purchase_date BETWEEN %s AND %s",
+        ("2025-01-01", "2025-01-31")
+    ),
+    "ledger_rows": (
+        "SELECT row_hash FROM ingestion_row WHERE row_hash = ANY(%s::bigint[])",
+        ([0],)
+    ),
+}
+
+# ======= MIGRACIÓN =======
+def create_table(cursor, table, columns):
+    """Crea la tabla si no existe y agrega las columnas faltantes (esquemas anteriores)."""
+    definition = ",\n    ".join(f"{column} {column_type}" for column, column_type in columns.items())
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {table} (\n    {definition}\n);")
+    for column, column_type in columns.items():
+        if "PRIMARY KEY" in column_type:
+            continue
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {column_type};")
+
+def create_index(cursor, name, table, columns, unique=False, where=None):
+    """
+    Crea un índice si no existe. Si un índice único no se puede crear porque
+    ya hay duplicados, se crea el índice normal equivalente (la consulta queda
+    cubierta) y se avisa; al limpiar los duplicados, el siguiente migrate crea
+    el único y quita el normal. Regresa el nombre del índice vigente.
+    """
+    condition = f" WHERE {where}" if where else ""
+    if not unique:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns}){condition};")
+        return name
+    fallback = name.removesuffix("_uq") + "_idx"
+    cursor.execute("SAVEPOINT create_index;")
+    try:
+        cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {table} ({columns}){condition};")
+    except psycopg2.errors.UniqueViolation:
+        cursor.execute("ROLLBACK TO SAVEPOINT create_index;")
+        print(f"⚠️ {table}: hay duplicados en ({columns}){condition}, se crea {fallback} sin restricción única")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {fallback} ON {table} ({columns}){condition};")
+        return fallback
+    cursor.execute("RELEASE SAVEPOINT create_index;")
+    cursor.execute(f"DROP INDEX IF EXISTS {fallback};")
+    return name
+
+def migrate(cursor):
+    """Crea/actualiza todas las tablas del proyecto y sus índices (idempotente)."""
+    cursor.execute("SELECT pg_advisory_xact_lock(%s);", (hash_key("ddl:schema"),))
+    for table, columns in TABLES.items():
+        print_log(f"Tabla {table}...")
+        create_table(cursor, table, columns)
+    for table, columns in NULLABLE_COLUMNS.items():
+        for column in columns:
+            cursor.execute(f"ALTER TABLE {table} ALTER COLUMN {column} DROP NOT NULL, ALTER COLUMN {column} DROP DEFAULT;")
+    cursor.execute(
+        """
+            INSERT INTO payment_type (payment_type)
+            SELECT name FROM unnest(%s::text[]) AS name
+            WHERE name NOT IN (SELECT payment_type FROM payment_type WHERE payment_type IS NOT NULL);
+        """,
+        (PAYMENT_TYPES,)
+    )
+    # Tablas que los módulos crean al primer uso
+    create_checkpoint_table(cursor)
+    create_ledger_tables(cursor)
+    create_statement_tables(cursor)
+    create_msi_plan_tables(cursor)
+    created = [create_index(cursor, name, *index) for name, index in INDEXES.items()]
+    for name in created:
+        print(f"- índice {name}")
+    if check_price_constraint(cursor):
+        print("⚠️ price conserva la restricción única en id_product: los precios se actualizan sin historial")
+    return created
+
+# ======= VERIFICACIÓN =======
+def _seq_scans(plan):
+    """Tablas recorridas con Seq Scan en un plan de EXPLAIN (FORMAT JSON)."""
+    tables = []
+    if plan.get("Node Type") == "Seq Scan":
+        tables.append(plan.get("Relation Name"))
+    for child in plan.get("Plans", []):
+        tables.extend(_seq_scans(child))
+    return tables
+
+def check(conn):
+    """
+    Ejecuta EXPLAIN de cada consulta de HOT_QUERIES y marca las que recorren
+    tablas con Seq Scan. Se desalienta el Seq Scan (enable_seqscan = off) para
+    que en bases pequeñas el planificador muestre si hay un índice utilizable:
+    si aun así elige Seq Scan, falta el índice. Regresa {consulta: tablas}.
+    """
+    flagged = {}
+    cur = conn.cursor()
+    for name, (query, params) in HOT_QUERIES.items():
+        try:
+            cur.execute("SET LOCAL enable_seqscan = off;")
+            cur.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+            plan = cur.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            tables = _seq_scans(plan[0]["Plan"])
+        except psycopg2.Error as e:
+            tables = [f"error: {str(e).strip()}"]
+        conn.rollback()
+        if tables:
+            flagged[name] = tables
+            print(f"❌ {name}: Seq Scan en {', '.join(sorted(set(tables)))}")
+        else:
+            print(f"✅ {name}")
+    return flagged
+
+# Uso del script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Esquema e índices de la base de ingesta")
+    parser.add_argument("command", choices=["migrate", "check"],
+                        help="migrate: crea/actualiza tablas e índices; check: EXPLAIN de las consultas críticas")
+    args = parser.parse_args()
+
+    with get_connection() as conn:
+        if args.command == "migrate":
+            try:
+                migrate(conn.cursor())
+                conn.commit()
+                print("✅ Esquema actualizado.")
+            except Exception as e:
+                conn.rollback()
+                print(f"❌ Error migrando el esquema: {e}")
+                sys.exit(1)
+        else:
+            flagged = check(conn)
+            print(f"Consultas con Seq Scan: {len(flagged)} de {len(HOT_QUERIES)}")
+            sys.exit(1 if flagged else 0)
@@ -1,15 +1,27 @@
 import configparser
+import io
 import os
+import pandas as pd
 import psycopg2
+import re
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+from psycopg2.extensions import connection as PgConnection
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 # Importar funciones generales
 from utils_tools import (
     print_log,
     get_store_name,
     get_domain_store,
     get_provider_store,
-    verify_url,
-    ensure_native
+    verify_urls,
+    encode_columns,
+    encode_rows,
+    encode_row
 )
+from hash_utils import hash_key
 
 # Configuración de la base de datos Postgres SQL
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -28,6 +40,186 @@ DB_CONFIG = {
 # Mapeo de catálogos
 CAT_PAYMENT_TYPE = {}
 CAT_STORE = {}
+# Índice de productos por archivo: nombre -> id_product y llaves de operación existentes
+CAT_PRODUCT = {}
+CAT_OPERATION = {}  # dict usado como conjunto ordenado (ver rollback_catalogs)
+# Proveedores por (id_store, provider_url)
+CAT_PROVIDER = {}
+# Esquema de price detectado (ver price_history_enabled)
+PRICE_SCHEMA = {}
+
+# Tipos de columnas para codificar parámetros (ver utils_tools.encode_columns)
+PURCHASE_TYPES = {
+    "id_provider": "int",
+    "id_payment_type": "int",
+    "total": "float",
+    "tax": "float",
+    "ieps": "float",
+    "purchase_date": "datetime",
+    "delivery_date": "datetime",
+    "exchange_rate": "float",
+    "shipping_cost": "float",
+    "discount": "float",
+}
+OPERATION_TYPES = {
+    "id_purchase": "int",
+    "id_product": "int",
+    "quantity": "int",
+    "unit_price": "float",
+    "unit_price_usd": "float",
+    "discount_percentage": "float",
+    "pieces_per_unit": "int",
+    "final_cost": "float",
+    "product_url": "text",
+}
+OPERATION_DEFAULTS = {
+    "discount_percentage": 0,
+    "pieces_per_unit": 1,
+    "product_url": "",
+}
+OPERATION_MAX_LENGTHS = {"product_url": 500}
+# Sin valor (o no numéricas) la operación se rechaza en lugar de insertarse con 0
+OPERATION_REQUIRED = ("quantity", "unit_price")
+PRICE_TYPES = {"id_product": "int", "price": "float", "offer_price": "float"}
+
+# ======= CONNECTION POOL =======
+
+# Conexiones por proceso: la ingesta usa una y la verificación de proveedores otra
+POOL_MIN_CONN = 1
+POOL_MAX_CONN = 4
+# Pool por pid: un proceso hijo (fork) crea el suyo y nunca toca las conexiones
+# heredadas del padre (cerrarlas terminaría la sesión del padre)
+CONNECTION_POOLS = {}
+
+class PreparedConnection(PgConnection):
+    """Conexión que recuerda las sentencias que ya preparó (PREPARE vive por sesión)."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+def get_pool():
+    """Pool de conexiones del proceso actual (se crea al primer uso)."""
+    pid = os.getpid()
+    if pid not in CONNECTION_POOLS:
+        CONNECTION_POOLS[pid] = ThreadedConnectionPool(
+            POOL_MIN_CONN, POOL_MAX_CONN, connection_factory=PreparedConnection, **DB_CONFIG
+        )
+    return CONNECTION_POOLS[pid]
+
+@contextmanager
+def get_connection():
+    """
+    Presta una conexión del pool. Al devolverla deshace lo que no se
+    confirmó; una conexión rota se cierra y el pool abre otra después.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        pool.putconn(conn, close=broken)
+
+# Aplicación de precios (ver apply_prices); {source} entrega (id_product, price, offer_price)
+PRICE_HISTORY_SQL = """
+    WITH s (id_product, price, offer_price) AS ({source}),
+    closed AS (
+        UPDATE price p SET end_date = CURRENT_DATE
+        FROM s
+        WHERE p.id_product = s.id_product
+          AND p.end_date IS NULL
+          AND (p.price IS DISTINCT FROM s.price OR p.offer_price IS DISTINCT FROM s.offer_price)
+        RETURNING p.id_product
+    )
+    INSERT INTO price (id_product, price, offer_price, start_date)
+    SELECT s.id_product, s.price, s.offer_price, CURRENT_DATE
+    FROM s
+    WHERE s.id_product IN (SELECT id_product FROM closed)
+       OR NOT EXISTS (
+            SELECT 1 FROM price p
+            WHERE p.id_product = s.id_product AND p.end_date IS NULL
+       )
+"""
+PRICE_LEGACY_SQL = """
+    WITH s (id_product, price, offer_price) AS ({source})
+    INSERT INTO price AS p (id_product, price, offer_price, start_date)
+    SELECT id_product, price, offer_price, CURRENT_DATE FROM s
+    ON CONFLICT (id_product) DO UPDATE SET
+        price = EXCLUDED.price,
+        offer_price = EXCLUDED.offer_price,
+        start_date = CASE
+            WHEN p.price IS DISTINCT FROM EXCLUDED.price
+              OR p.offer_price IS DISTINCT FROM EXCLUDED.offer_price
+            THEN CURRENT_DATE ELSE p.start_date
+        END
+"""
+
+# Sentencias fijas del flujo de ingesta: se preparan una vez por conexión.
+# Los parámetros ($n) van en orden y una sola vez (ver execute_prepared).
+PREPARED_STATEMENTS = {
+    "ins_store": """
+        INSERT INTO store (store_name, store_url, status)
+        VALUES ($1, $2, TRUE)
+        ON CONFLICT (store_name) DO UPDATE
+        SET store_url = EXCLUDED.store_url
+        RETURNING id_store
+    """,
+    "sel_provider": """
+        SELECT id_provider FROM provider
+        WHERE id_store = $1 AND provider_url = $2
+    """,
+    "ins_provider": """
+        INSERT INTO provider (id_store, provider_url, is_active)
+        VALUES ($1, $2, NULL)
+        RETURNING id_provider
+    """,
+    "ins_product": """
+        INSERT INTO product (product_name, description, image_url)
+        VALUES ($1, $2, $3)
+        RETURNING id_product
+    """,
+    "ins_product_brand": """
+        INSERT INTO product (product_name, description, image_url, brand, category)
+        VALUES ($1, $2, $3, $4, $5)
+        RETURNING id_product
+    """,
+    "ins_purchase": """
+        INSERT INTO purchase (
+            id_provider, id_payment_type, total, tax, ieps,
+            purchase_date, delivery_date, exchange_rate, shipping_cost, discount
+        ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+        RETURNING id_purchase
+    """,
+    "ins_operation": """
+        INSERT INTO operation (
+            id_purchase, id_product, quantity, unit_price, unit_price_usd,
+            discount_percentage, pieces_per_unit, final_cost, product_url
+        ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+    """,
+    "apply_price": PRICE_HISTORY_SQL.format(source="VALUES ($1::int, $2::numeric, $3::numeric)"),
+    "apply_price_legacy": PRICE_LEGACY_SQL.format(source="VALUES ($1::int, $2::numeric, $3::numeric)"),
+}
+
+def execute_prepared(cursor, name, params):
+    """
+    Ejecuta una sentencia de PREPARED_STATEMENTS con EXECUTE y la prepara la
+    primera vez que se usa en la conexión (PREPARE no se deshace con rollback).
+    Con una conexión fuera del pool se ejecuta como consulta normal.
+    """
+    sql = PREPARED_STATEMENTS[name]
+    prepared = getattr(cursor.connection, "prepared", None)
+    if prepared is None:
+        cursor.execute(re.sub(r"\$\d+", "%s", sql), params)
+        return
+    if name not in prepared:
+        cursor.execute(f"PREPARE {name} AS {sql}")
+        prepared.add(name)
+    cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
 
 # ======= DB GET CATALOGS =======
 def get_catalogs(cursor):
@@ -36,10 +228,111 @@ def get_catalogs(cursor):
     cursor.execute("SELECT id_payment_type, payment_type FROM payment_type ;")
     CAT_PAYMENT_TYPE.update({name: id for id, name in cursor.fetchall()})
 
-    # Obtener tiendas
+    # Obtener tiendas (se recarga completo: otro proceso pudo crear tiendas)
     cursor.execute("SELECT id_store, store_name FROM store;")
+    CAT_STORE.clear()
     CAT_STORE.update({name: id for id, name in cursor.fetchall()})
 
+def _lock_key(text):
+    """Llave bigint estable para pg_advisory_xact_lock."""
+    return hash_key(text)
+
+def lock_catalogs(cursor, storeUrls, productNames):
+    """
+    Toma locks de transacción (pg_advisory_xact_lock) sobre las tiendas,
+    proveedores y productos que el archivo puede crear, para que varios
+    procesos de ingesta no dupliquen catálogos. Los locks se toman en orden
+    para evitar deadlocks y se liberan con el commit/rollback.
+    """
+    keys = set()
+    for url in storeUrls:
+        store_name = get_store_name(url) if url else None
+        if store_name is None or store_name == "none":
+            continue
+        keys.add(f"store:{store_name}")
+        keys.add(f"provider:{store_name}:{get_provider_store(url)}")
+    keys.update(f"product:{name}" for name in productNames if name)
+    lock_keys = sorted({_lock_key(key) for key in keys})
+    print_log(f"lock_catalogs: {len(lock_keys)} locks")
+    if lock_keys:
+        cursor.execute("SELECT pg_advisory_xact_lock(k) FROM unnest(%s::bigint[]) AS k;", (lock_keys,))
+
+def load_product_index(cursor, productNames):
+    """
+    Precarga en memoria los productos del archivo y sus llaves de operación
+    (id_product, quantity, unit_price, purchase_date) en dos consultas.
+    """
+    CAT_PRODUCT.clear()
+    CAT_OPERATION.clear()
+    names = list({name for name in productNames if name})
+    if not names:
+        return
+    cursor.execute(
+        """
+            SELECT product_name, id_product FROM product
+            WHERE product_name = ANY(%s)
+            ORDER BY id_product;
+        """,
+        (names,)
+    )
+    for name, id_product in cursor.fetchall():
+        CAT_PRODUCT.setdefault(name, id_product)
+    cursor.execute(
+        """
+            SELECT o.id_product, o.quantity, o.unit_price, p.purchase_date
+            FROM operation o
+            JOIN purchase p ON o.id_purchase = p.id_purchase
+            WHERE o.id_product = ANY(%s);
+        """,
+        (list(CAT_PRODUCT.values()),)
+    )
+    CAT_OPERATION.update(dict.fromkeys(operation_key(*row) for row in cursor.fetchall()))
+    print_log(f"Índice de productos: {len(CAT_PRODUCT)} productos, {len(CAT_OPERATION)} operaciones")
+
+def load_providers(cursor, storeUrls):
+    """
+    Precarga los proveedores del archivo y crea los faltantes en un solo INSERT.
+    storeUrls: pares (id_store, url) de las filas del archivo.
+    """
+    CAT_PROVIDER.clear()
+    pairs = {
+        (id_store, provider_url)
+        for id_store, provider_url in (
+            (id_store, get_provider_store(url)) for id_store, url in storeUrls
+        )
+        if id_store is not None and provider_url is not None
+    }
+    if not pairs:
+        return
+    id_stores, provider_urls = zip(*pairs)
+    cursor.execute(
+        """
+            SELECT p.id_store, p.provider_url, p.id_provider
+            FROM provider p
+            JOIN unnest(%s::int[], %s::text[]) AS k(id_store, provider_url)
+              ON p.id_store = k.id_store AND p.provider_url = k.provider_url;
+        """,
+        (list(id_stores), list(provider_urls))
+    )
+    CAT_PROVIDER.update({(id_store, url): id_provider for id_store, url, id_provider in cursor.fetchall()})
+    missing = sorted(pairs - CAT_PROVIDER.keys())
+    print_log(f"Proveedores existentes: {len(CAT_PROVIDER)}, nuevos: {len(missing)}")
+    if not missing:
+        return
+    # is_active queda en NULL (sin verificar) hasta verify_pending_providers
+    rows = execute_values(
+        cursor,
+        """
+            INSERT INTO provider (id_store, provider_url, is_active)
+            VALUES %s
+            RETURNING id_store, provider_url, id_provider;
+        """,
+        missing,
+        template="(%s, %s, NULL)",
+        fetch=True
+    )
+    CAT_PROVIDER.update({(id_store, url): id_provider for id_store, url, id_provider in rows})
+
 # ==== FUNCIONES AUXILIARES ====
 def get_id_payment_type(strPayment):
     """Obtiene id_payment_type."""
@@ -52,6 +345,39 @@ def get_id_payment_type(strPayment):
     else:
         return None
 
+def operation_key(idProduct, quantity, unitPrice, prchsDate):
+    """Llave normalizada de operación (compara igual entre valores de BD y del DataFrame)."""
+    prchs_date = prchsDate
+    if isinstance(prchs_date, datetime) and prchs_date.time() == datetime.min.time():
+        prchs_date = prchs_date.date()
+    return (
+        int(idProduct),
+        round(float(quantity), 6) if quantity is not None else None,
+        round(float(unitPrice), 6) if unitPrice is not None else None,
+        prchs_date
+    )
+
+def register_operation(idProduct, quantity, unitPrice, prchsDate):
+    """Registra en el índice una operación recién insertada (o pendiente de insertar)."""
+    CAT_OPERATION[operation_key(idProduct, quantity, unitPrice, prchsDate)] = None
+
+# Catálogos que una fila puede modificar (se deshacen junto con su SAVEPOINT)
+ROW_CATALOGS = (CAT_STORE, CAT_PROVIDER, CAT_PRODUCT, CAT_OPERATION)
+
+def catalog_savepoint():
+    """Marca el tamaño de los catálogos en memoria antes de procesar una fila."""
+    return [len(catalog) for catalog in ROW_CATALOGS]
+
+def rollback_catalogs(marks):
+    """
+    Deshace lo agregado a los catálogos después de catalog_savepoint(marks).
+    Las filas solo agregan llaves y los dicts conservan el orden de inserción,
+    así que basta con quitar las últimas llaves de cada catálogo.
+    """
+    for catalog, size in zip(ROW_CATALOGS, marks):
+        for key in list(islice(reversed(catalog), len(catalog) - size)):
+            del catalog[key]
+
 # ======= FUNCTIONS FOR DATA INGESTION =======
 
 def get_or_create_store(cursor, storeUrl=None):
@@ -67,16 +393,7 @@ def get_or_create_store(cursor, storeUrl=None):
         return CAT_STORE[store_name]
     domain_store = get_domain_store(storeUrl)
     print_log(f"* INSERT INTO store ({store_name},{domain_store})...")
-    cursor.execute(
-        """
-            INSERT INTO store (store_name, store_url, status)
-            VALUES (%s, %s, TRUE)
-            ON CONFLICT (store_name) DO UPDATE
-            SET store_url = EXCLUDED.store_url
-            RETURNING id_store;
-        """,
-        (store_name, domain_store)
-    )
+    execute_prepared(cursor, "ins_store", (store_name, domain_store))
     id_store = cursor.fetchone()[0]
     print_log(f"id_store: {id_store}")
     CAT_STORE[store_name] = id_store
@@ -87,57 +404,31 @@ def get_or_create_provider(cursor, idStore, strUrl=None):
     print_log(f"idStore: {idStore}, strUrl: {strUrl}")
     provider_url = get_provider_store(strUrl)
     print_log(f"provider_url: {provider_url}")
-    cursor.execute(
-        """
-            SELECT id_provider FROM provider
-            WHERE id_store = %s AND provider_url = %s;
-        """,
-        (idStore, provider_url)
-    )
+    if (idStore, provider_url) in CAT_PROVIDER:
+        return CAT_PROVIDER[(idStore, provider_url)]
+    execute_prepared(cursor, "sel_provider", (idStore, provider_url))
     id_provider = cursor.fetchone()
     print_log(f"id_provider: {id_provider}")
     if id_provider:
+        CAT_PROVIDER[(idStore, provider_url)] = id_provider[0]
         return id_provider[0]
-    is_active = verify_url(provider_url)
-    print_log(f"is_active: {is_active}")
-    cursor.execute(
-        """
-            INSERT INTO provider (id_store, provider_url, is_active)
-            VALUES (%s, %s, %s)
-            RETURNING id_provider;
-        """,
-        (idStore, provider_url, is_active)
-    )
+    # is_active queda en NULL (sin verificar) hasta verify_pending_providers
+    execute_prepared(cursor, "ins_provider", (idStore, provider_url))
     id_provider = cursor.fetchone()[0]
     print_log(f"id_provider: {id_provider}")
+    CAT_PROVIDER[(idStore, provider_url)] = id_provider
     return id_provider
 
 def create_product(cursor, data, productName, descr=None, quantity=None, unitPrice=None, prchsDate=None):
     """ Obtiene o crea un producto validando coincidencias en producto, operación y compra. """
     imageUrl = data["Picture_URL"]
     print_log(f"imageUrl: {imageUrl}")
-    # 1️⃣ Buscar producto por nombre
-    cursor.execute(
-        "SELECT id_product FROM product WHERE product_name = %s", (productName,)
-    )
-    row = cursor.fetchone()
-    print_log(f"imageUrl: {imageUrl}")
-    if row:
-        id_product = row[0]
+    # 1️⃣ Buscar producto por nombre (índice precargado con load_product_index)
+    id_product = CAT_PRODUCT.get(productName)
+    if id_product is not None:
         # 2️⃣ Validar en operation + purchase (si se pasaron todos los datos)
         if quantity is not None and unitPrice is not None and prchsDate is not None:
-            cursor.execute(
-                """
-                SELECT 1
-                FROM operation o
-                JOIN purchase p ON o.id_purchase = p.id_purchase
-                WHERE o.id_product = %s AND o.quantity = %s AND o.unit_price = %s AND p.purchase_date = %s
-                LIMIT 1
-                """,
-                (id_product, quantity, unitPrice, prchsDate)
-            )
-            op_match = cursor.fetchone()
-            if op_match:
+            if operation_key(id_product, quantity, unitPrice, prchsDate) in CAT_OPERATION:
                 print_log(f"Producto existente con datos coincidentes: {id_product}")
                 return {"id_product": id_product, "continue": False}
             else:
@@ -150,134 +441,571 @@ def create_product(cursor, data, productName, descr=None, quantity=None, unitPri
     brand = data["Marca"]
     category = data["Categoria"]
     print_log(f"brand: {brand}, category: {category}")
-    query_inser = ""
-    values = None
     if brand and category:
-        query_inser = """
-            INSERT INTO product (product_name, description, image_url, brand, category)
-            VALUES (%s, %s, %s, %s, %s)
-            RETURNING id_product;
-        """
+        statement = "ins_product_brand"
         values = (productName, descr, imageUrl, brand, category)
     else:
-        query_inser = """
-            INSERT INTO product (product_name, description, image_url)
-            VALUES (%s, %s, %s)
-            RETURNING id_product;
-        """
+        statement = "ins_product"
         values = (productName, descr, imageUrl)
     print_log(f"INSERT INTO product ({productName})...")
-    cursor.execute(query_inser, values)
+    execute_prepared(cursor, statement, values)
     id_product = cursor.fetchone()[0]
     print_log(f"id_product creado: {id_product}")
+    CAT_PRODUCT[productName] = id_product
     return {"id_product": id_product, "continue": True}
 
 def insert_purchase(cursor, prchsData):
-    """Inserta una compra y sus operaciones relacionadas."""
-    # Insertar compra
-    values = (
-        prchsData["id_provider"],
-        prchsData["id_payment_type"],
-        prchsData["total"],
-        prchsData["tax"],
-        prchsData["ieps"],
-        prchsData["purchase_date"],
-        prchsData.get("delivery_date"),
-        prchsData.get("exchange_rate"),
-        prchsData.get("shipping_cost", 0),
-        prchsData.get("discount", 0)
-    )
+    """Inserta una compra y devuelve su id_purchase."""
+    values = encode_row(prchsData, PURCHASE_TYPES)
     print_log(f"values: {values}")
     print_log("INSERT INTO purchase ()...")
-    cursor.execute(
-        """
-            INSERT INTO purchase (
-                id_provider, id_payment_type, total, tax, ieps,
-                purchase_date, delivery_date, exchange_rate, shipping_cost, discount
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id_purchase;
-        """,
-        values
-    )
+    execute_prepared(cursor, "ins_purchase", values)
     id_purchase = cursor.fetchone()[0]
     print_log(f"id_purchase: {id_purchase}")
     return id_purchase
 
 def insert_operations(cursor, idPurchase, idProduct, operationItems):
-    """Versión definitiva con triple validación de tipos"""
-    for item in operationItems:
+    """Inserta las operaciones de una compra (parámetros codificados por valor)."""
+    params_list = [
+        encode_row(
+            {**item, "id_purchase": idPurchase, "id_product": idProduct},
+            OPERATION_TYPES, OPERATION_DEFAULTS, OPERATION_MAX_LENGTHS
+        )
+        for item in operationItems
+    ]
+    for params in params_list:
         try:
-            # Primera conversión
-            safe_item = {k: ensure_native(v) for k, v in item.items()}
-            print_log(f"* safe_item: {safe_item}")
-            # Segunda conversión explícita
-            params = (
-                int(ensure_native(idPurchase)),
-                int(ensure_native(idProduct)),
-                int(ensure_native(safe_item.get("quantity", 0))),
-                float(ensure_native(safe_item.get("unit_price", 0))),
-                float(ensure_native(safe_item.get("unit_price_usd"))) if safe_item.get("unit_price_usd") is not None else None,
-                float(ensure_native(safe_item.get("discount_percentage"))) if safe_item.get("discount_percentage") is not None else 0,
-                int(ensure_native(safe_item.get("pieces_per_unit", 1))),
-                float(ensure_native(safe_item.get("final_cost"))) if safe_item.get("final_cost") is not None else None,
-                str(ensure_native(safe_item.get("product_url", "")))[:500]
-            )
-            # Tercera validación
-            for i, param in enumerate(params):
-                if param is not None and type(param).__module__.startswith('numpy'):
-                    raise TypeError(f"Parámetro {i} sigue siendo NumPy: {type(param)}")
-            print_log(f"Params verificados: {params}")
-            print_log(f"Tipos verificados: {[type(p) for p in params]}")
-            # Consulta parametrizada
-            query = """
-                INSERT INTO operation (
-                    id_purchase, id_product, quantity, unit_price, unit_price_usd,
-                    discount_percentage, pieces_per_unit, final_cost, product_url
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            cursor.execute(query, params)
+            print_log(f"Params: {params}")
+            values = dict(zip(OPERATION_TYPES, params))
+            missing = [column for column in OPERATION_REQUIRED if values[column] is None]
+            if missing:
+                raise ValueError(f"Operación sin {', '.join(missing)}")
+            execute_prepared(cursor, "ins_operation", params)
         except Exception as e:
             print_log(f"❌ ERROR FATAL: {str(e)}")
-            print_log(f"Datos originales: {item}")
-            print_log(f"Tipos originales: {[type(v) for v in item.values()]}")
             print_log(f"Params fallidos: {params}")
             raise RuntimeError("Error crítico en inserción") from e
     return True
 
 def check_price_constraint(cursor):
-    """Verifica si existe la restricción única en id_product"""
+    """Verifica si existe la restricción única (solo) en id_product"""
     cursor.execute("""
         SELECT 1 FROM pg_constraint 
         WHERE conrelid = 'price'::regclass 
         AND contype IN ('u', 'p')  -- 'u' para UNIQUE, 'p' para PRIMARY KEY
-        AND conkey::int[] @> ARRAY[
+        AND conkey = ARRAY[
             (SELECT attnum FROM pg_attribute 
              WHERE attrelid = 'price'::regclass AND attname = 'id_product')
         ]
     """)
     return cursor.fetchone() is not None
 
+def price_history_enabled(cursor):
+    """
+    Indica si price guarda historial (varias filas por producto). Con la
+    restricción única heredada en id_product solo cabe una fila por producto.
+    Se consulta una vez por proceso.
+    """
+    if "history" not in PRICE_SCHEMA:
+        PRICE_SCHEMA["history"] = not check_price_constraint(cursor)
+        print_log(f"Historial de precios: {PRICE_SCHEMA['history']}")
+    return PRICE_SCHEMA["history"]
+
+def apply_prices(cursor, priceRows):
+    """
+    Aplica en bloque los precios de un archivo (dicts con id_product, price y
+    offer_price). Si un producto aparece varias veces, gana la última fila.
+    Con historial, un precio que cambió cierra su fila vigente (end_date) y
+    abre una nueva; los productos sin fila vigente la reciben y los precios
+    iguales no se tocan, todo en una sola sentencia. Con el esquema heredado
+    (id_product único) se actualiza en su lugar con INSERT ... ON CONFLICT.
+    Regresa el número de productos aplicados.
+    """
+    priceRows = list(priceRows)
+    if not priceRows:
+        return 0
+    history = price_history_enabled(cursor)
+    if len(priceRows) == 1:
+        values = [encode_row(priceRows[0], PRICE_TYPES)]
+        execute_prepared(cursor, "apply_price" if history else "apply_price_legacy", values[0])
+    else:
+        df_rows = pd.DataFrame(priceRows).drop_duplicates("id_product", keep="last")
+        values = encode_rows(df_rows[list(PRICE_TYPES)], PRICE_TYPES)
+        execute_values(
+            cursor,
+            (PRICE_HISTORY_SQL if history else PRICE_LEGACY_SQL).format(source="VALUES %s"),
+            values,
+            template="(%s::int, %s::numeric, %s::numeric)",
+            page_size=1000
+        )
+    print_log(f"Precios aplicados: {len(values)}")
+    return len(values)
+
 def insert_price(cursor, idProduct, priceData):
-    """Versión sin ON CONFLICT"""
-    # Conversión segura de tipos NumPy
-    price_val = float(priceData["price"]) if priceData["price"] is not None else None
-    offer_val = float(priceData.get("offer_price")) if priceData.get("offer_price") is not None else None
-    # UPSERT manual en dos pasos
+    """Aplica el precio de un producto (ver apply_prices)."""
+    return apply_prices(cursor, [{"id_product": idProduct, **priceData}])
+
+# ======= PROVIDER VERIFICATION =======
+
+def verify_pending_providers(batchSize=500):
+    """
+    Verifica fuera de la ingesta los proveedores sin verificar (is_active NULL)
+    y actualiza provider.is_active por lotes, con un commit por lote.
+    """
+    verified = 0
+    with get_connection() as conn:
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT id_provider, provider_url FROM provider WHERE is_active IS NULL ORDER BY id_provider;")
+            pending = cur.fetchall()
+            print_log(f"Proveedores por verificar: {len(pending)}")
+            for start in range(0, len(pending), batchSize):
+                batch = pending[start:start + batchSize]
+                url_status = verify_urls(provider_url for _, provider_url in batch)
+                execute_values(
+                    cur,
+                    """
+                        UPDATE provider p SET is_active = v.is_active
+                        FROM (VALUES %s) AS v(id_provider, is_active)
+                        WHERE p.id_provider = v.id_provider;
+                    """,
+                    [(id_provider, bool(url_status.get(provider_url))) for id_provider, provider_url in batch]
+                )
+                conn.commit()
+                verified += len(batch)
+            print_log(f"Proveedores verificados: {verified}")
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ Error verificando proveedores: {e}")
+    return verified
+
+# ======= FUNCTIONS FOR BULK INGESTION =======
+
+# Columnas de compra + operación que se cargan en staging (en orden)
+STAGE_PURCHASE_TYPES = {
+    "ord": "int",
+    **PURCHASE_TYPES,
+    **{col: col_type for col, col_type in OPERATION_TYPES.items() if col != "id_purchase"}
+}
+STAGE_PURCHASE_COLUMNS = tuple(STAGE_PURCHASE_TYPES)
+
+def create_staging_tables(cursor):
+    """Crea la tabla temporal de staging de compras (se elimina al hacer commit)."""
     cursor.execute("""
-        UPDATE price SET
-            price = %s,
-            offer_price = %s,
-            end_date = CASE WHEN price != %s THEN CURRENT_DATE ELSE end_date END,
-            start_date = CASE WHEN price != %s THEN CURRENT_DATE ELSE start_date END
-        WHERE id_product = %s
-    """, (price_val, offer_val, price_val, price_val, idProduct))
-    
-    if cursor.rowcount == 0:  # Si no actualizó nada, insertar nuevo
-        cursor.execute("""
-            INSERT INTO price (
-                id_product, price, offer_price, start_date
-            ) VALUES (%s, %s, %s, CURRENT_DATE)
-        """, (idProduct, price_val, offer_val))
+        DROP TABLE IF EXISTS stg_purchase;
+        CREATE TEMP TABLE stg_purchase ON COMMIT DROP AS
+        SELECT
+            0::INTEGER AS ord, p.*,
+            o.id_product, o.quantity, o.unit_price, o.unit_price_usd,
+            o.discount_percentage, o.pieces_per_unit, o.final_cost, o.product_url
+        FROM purchase p, operation o
+        WITH NO DATA;
+    """)
+
+def bulk_insert_purchases(cursor, purchaseRows):
+    """
+    Inserta en bloque compras y operaciones (una por compra).
+    Carga las filas en staging con execute_values, asigna los id_purchase
+    desde la secuencia y resuelve ambos INSERT ... SELECT en el servidor.
+    """
+    if not purchaseRows:
+        return []
+    df_rows = pd.DataFrame(list(purchaseRows))
+    df_rows["ord"] = range(len(df_rows))
+    columns = encode_columns(df_rows, STAGE_PURCHASE_TYPES, OPERATION_DEFAULTS, OPERATION_MAX_LENGTHS)
+    # Una fila sin cantidad/precio hace fallar el bloque: la ingesta lo reintenta
+    # fila por fila y rechaza solo esa fila
+    missing = [column for column in OPERATION_REQUIRED if None in columns[column]]
+    if missing:
+        raise ValueError(f"Compras del bloque sin {', '.join(missing)}")
+    values = list(zip(*columns.values()))
+    print_log(f"INSERT {len(values)} filas en stg_purchase...")
+    execute_values(
+        cursor,
+        f"INSERT INTO stg_purchase ({', '.join(STAGE_PURCHASE_COLUMNS)}) VALUES %s",
+        values,
+        page_size=1000
+    )
+    cursor.execute(
+        """
+            UPDATE stg_purchase
+            SET id_purchase = nextval(pg_get_serial_sequence('purchase', 'id_purchase'));
+
+            INSERT INTO purchase (
+                id_purchase, id_provider, id_payment_type, total, tax, ieps,
+                purchase_date, delivery_date, exchange_rate, shipping_cost, discount
+            )
+            SELECT
+                id_purchase, id_provider, id_payment_type, total, tax, ieps,
+                purchase_date, delivery_date, exchange_rate, shipping_cost, discount
+            FROM stg_purchase
+            ORDER BY ord;
+
+            INSERT INTO operation (
+                id_purchase, id_product, quantity, unit_price, unit_price_usd,
+                discount_percentage, pieces_per_unit, final_cost, product_url
+            )
+            SELECT
+                id_purchase, id_product, quantity, unit_price, unit_price_usd,
+                discount_percentage, pieces_per_unit, final_cost, product_url
+            FROM stg_purchase
+            ORDER BY ord;
+
+            SELECT id_purchase FROM stg_purchase ORDER BY ord;
+        """
+    )
+    id_purchases = [id_purchase for id_purchase, in cursor.fetchall()]
+    print_log(f"Compras insertadas en bloque: {len(id_purchases)}")
+    return id_purchases
+
+def bulk_insert_prices(cursor, priceRows):
+    """Aplica en bloque los precios (mismas reglas que insert_price)."""
+    return apply_prices(cursor, priceRows)
+
+# ======= INGESTION CHECKPOINTS =======
+
+def create_checkpoint_table(cursor):
+    """Crea (si no existe) la tabla con el avance de ingesta por archivo."""
+    cursor.execute("SELECT pg_advisory_xact_lock(%s);", (_lock_key("ddl:ingestion_checkpoint"),))
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ingestion_checkpoint (
+            file_name VARCHAR(255) PRIMARY KEY,
+            last_row INTEGER NOT NULL,
+            rejected_rows INTEGER NOT NULL DEFAULT 0,
+            file_hash CHAR(64),
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    """)
+
+def get_checkpoint(cursor, fileName, fileHash=None):
+    """
+    Avance del archivo: (última fila confirmada, filas rechazadas acumuladas).
+    Regresa (-1, 0) si no tiene avance registrado o si el avance es de otra
+    versión del archivo con el mismo nombre.
+    """
+    cursor.execute(
+        "SELECT last_row, rejected_rows, file_hash FROM ingestion_checkpoint WHERE file_name = %s;",
+        (fileName,)
+    )
+    row = cursor.fetchone()
+    if row is None or (fileHash and row[2] and row[2] != fileHash):
+        return -1, 0
+    return row[0], row[1]
+
+def save_checkpoint(cursor, fileName, lastRow, rejectedRows=0, fileHash=None):
+    """Registra la última fila del bloque (va en la misma transacción que el bloque)."""
+    cursor.execute(
+        """
+            INSERT INTO ingestion_checkpoint (file_name, last_row, rejected_rows, file_hash)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (file_name) DO UPDATE SET
+                last_row = EXCLUDED.last_row,
+                rejected_rows = CASE
+                    WHEN ingestion_checkpoint.file_hash IS DISTINCT FROM EXCLUDED.file_hash
+                    THEN EXCLUDED.rejected_rows
+                    ELSE ingestion_checkpoint.rejected_rows + EXCLUDED.rejected_rows
+                END,
+                file_hash = EXCLUDED.file_hash,
+                updated_at = now();
+        """,
+        (fileName, lastRow, rejectedRows, fileHash)
+    )
+
+def clear_checkpoint(cursor, fileName):
+    """Elimina el avance de un archivo terminado (una nueva corrida empieza desde cero)."""
+    cursor.execute("DELETE FROM ingestion_checkpoint WHERE file_name = %s;", (fileName,))
+
+# ======= INGESTION LEDGER =======
+
+def create_ledger_tables(cursor):
+    """
+    Crea (si no existen) las tablas de huellas de ingesta: una por archivo
+    cargado (SHA-256 del contenido) y una por compra insertada (hash_key de
+    sus columnas llave normalizadas).
+    """
+    cursor.execute("SELECT pg_advisory_xact_lock(%s);", (_lock_key("ddl:ingestion_ledger"),))
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ingestion_file (
+            file_hash CHAR(64) PRIMARY KEY,
+            file_name VARCHAR(255),
+            row_count INTEGER NOT NULL DEFAULT 0,
+            loaded_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+
+        CREATE TABLE IF NOT EXISTS ingestion_row (
+            row_hash BIGINT PRIMARY KEY,
+            file_hash CHAR(64),
+            loaded_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    """)
+
+def is_file_loaded(fileHash):
+    """Indica si un archivo con ese contenido ya se cargó completo (una consulta)."""
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT EXISTS (SELECT 1 FROM ingestion_file WHERE file_hash = %s);", (fileHash,))
+        loaded = cur.fetchone()[0]
+        conn.commit()
+    return loaded
+
+def load_row_hashes(cursor, rowHashes):
+    """Subconjunto de rowHashes que ya está en el ledger (para el anti-join)."""
+    cursor.execute(
+        "SELECT row_hash FROM ingestion_row WHERE row_hash = ANY(%s::bigint[]);",
+        ([int(row_hash) for row_hash in rowHashes],)
+    )
+    return {row_hash for row_hash, in cursor.fetchall()}
+
+def record_rows(cursor, fileHash, rowHashes):
+    """Registra las compras insertadas (va en la misma transacción que el bloque)."""
+    if not rowHashes:
+        return
+    execute_values(
+        cursor,
+        "INSERT INTO ingestion_row (row_hash, file_hash) VALUES %s ON CONFLICT (row_hash) DO NOTHING;",
+        [(int(row_hash), fileHash) for row_hash in rowHashes],
+        page_size=1000
+    )
+
+def record_file(cursor, fileHash, fileName, rowCount):
+    """Marca el archivo como cargado: una nueva corrida con el mismo contenido se omite."""
+    cursor.execute(
+        """
+            INSERT INTO ingestion_file (file_hash, file_name, row_count)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (file_hash) DO UPDATE SET
+                file_name = EXCLUDED.file_name,
+                row_count = EXCLUDED.row_count,
+                loaded_at = now();
+        """,
+        (fileHash, fileName, rowCount)
+    )
+
+# ======= FUNCTIONS FOR CARD STATEMENTS =======
+
+# Columnas destino -> columnas de los DataFrames de pdf_to_xlsx (en orden de COPY)
+CARD_MSI_COLUMNS = {
+    "operation_date": "Fecha operación",
+    "description": "Descripción",
+    "original_amount": "Monto original",
+    "pending_balance": "Saldo pendiente",
+    "required_payment": "Pago requerido",
+    "payment_number": "Núm. de pago",
+    "interest_rate": "Tasa de interés aplicable",
+}
+CARD_CHARGE_COLUMNS = {
+    "operation_date": "Fecha de la operación",
+    "charge_date": "Fecha de cargo",
+    "amount": "Pago requerido",
+    "description": "Descripción",
+}
+
+def create_statement_tables(cursor):
+    """Crea (si no existen) las tablas de estados de cuenta de tarjeta."""
+    # Serializa el DDL entre procesos que cargan estados en paralelo
+    cursor.execute("SELECT pg_advisory_xact_lock(%s);", (_lock_key("ddl:card_statement"),))
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS card_statement (
+            id_statement SERIAL PRIMARY KEY,
+            content_hash CHAR(64) NOT NULL UNIQUE,
+            pdf_name VARCHAR(255),
+            operation_date DATE,
+            msi_rows INTEGER NOT NULL DEFAULT 0,
+            charge_rows INTEGER NOT NULL DEFAULT 0,
+            loaded_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+
+        CREATE TABLE IF NOT EXISTS card_msi (
+            id_statement INTEGER NOT NULL REFERENCES card_statement ON DELETE CASCADE,
+            row_num INTEGER NOT NULL,
+            operation_date DATE,
+            description VARCHAR(255),
+            original_amount NUMERIC(12,2),
+            pending_balance NUMERIC(12,2),
+            required_payment NUMERIC(12,2),
+            payment_number VARCHAR(20),
+            interest_rate VARCHAR(20),
+            PRIMARY KEY (id_statement, row_num)
+        );
+
+        CREATE TABLE IF NOT EXISTS card_charge (
+            id_statement INTEGER NOT NULL REFERENCES card_statement ON DELETE CASCADE,
+            row_num INTEGER NOT NULL,
+            operation_date DATE,
+            charge_date DATE,
+            amount NUMERIC(12,2),
+            description VARCHAR(255),
+            PRIMARY KEY (id_statement, row_num)
+        );
+    """)
+
+def _copy_frame(cursor, table, df, columnMap, idStatement):
+    """Carga un DataFrame con COPY ... FROM STDIN (CSV en memoria)."""
+    df_copy = pd.DataFrame({"id_statement": idStatement, "row_num": range(len(df))}, index=df.index)
+    for column, source in columnMap.items():
+        df_copy[column] = df[source]
+    buffer = io.StringIO()
+    df_copy.to_csv(buffer, header=False, index=False, date_format="%Y-%m-%d")
+    buffer.seek(0)
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(df_copy.columns)}) FROM STDIN WITH (FORMAT csv)",
+        buffer
+    )
+    return len(df_copy)
+
+def load_statement(cursor, contentHash, pdfName, operationDate, dfMsi, dfCharges, msiSnapshot=True):
+    """
+    Carga un estado de cuenta de forma idempotente: el estado se identifica por
+    el hash de su contenido (upsert en card_statement) y sus filas se reemplazan
+    completas (DELETE + COPY), así que volver a cargarlo no duplica cargos.
+    Con msiSnapshot=False no se copian las filas MSI a card_msi: los planes se
+    guardan solo como cambios en msi_plan/msi_plan_event.
+    Regresa el id_statement.
+    """
+    cursor.execute(
+        """
+            INSERT INTO card_statement (content_hash, pdf_name, operation_date, msi_rows, charge_rows)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (content_hash) DO UPDATE SET
+                pdf_name = EXCLUDED.pdf_name,
+                operation_date = EXCLUDED.operation_date,
+                msi_rows = EXCLUDED.msi_rows,
+                charge_rows = EXCLUDED.charge_rows,
+                loaded_at = now()
+            RETURNING id_statement;
+        """,
+        (contentHash, pdfName, operationDate, len(dfMsi), len(dfCharges))
+    )
+    id_statement = cursor.fetchone()[0]
+    cursor.execute("DELETE FROM card_msi WHERE id_statement = %s;", (id_statement,))
+    cursor.execute("DELETE FROM card_charge WHERE id_statement = %s;", (id_statement,))
+    if msiSnapshot:
+        _copy_frame(cursor, "card_msi", dfMsi, CARD_MSI_COLUMNS, id_statement)
+    charge_rows = _copy_frame(cursor, "card_charge", dfCharges, CARD_CHARGE_COLUMNS, id_statement)
+    print_log(f"Estado {pdfName} (id {id_statement}): {len(dfMsi)} MSI, {charge_rows} cargos")
+    return id_statement
+
+# ======= MSI PLAN TRACKING =======
+
+# Llave natural de un plan a meses: seq distingue planes idénticos del mismo estado
+MSI_PLAN_KEY = ["operation_date", "description", "original_amount", "seq"]
+MSI_PLAN_STATE = ["payment_number", "total_payments", "pending_balance", "required_payment", "interest_rate"]
+
+def create_msi_plan_tables(cursor):
+    """Crea (si no existen) el índice de planes MSI y su historial de cambios."""
+    cursor.execute("SELECT pg_advisory_xact_lock(%s);", (_lock_key("ddl:msi_plan"),))
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS msi_plan (
+            id_plan SERIAL PRIMARY KEY,
+            operation_date DATE NOT NULL,
+            description VARCHAR(255) NOT NULL,
+            original_amount NUMERIC(12,2) NOT NULL,
+            seq INTEGER NOT NULL DEFAULT 0,
+            payment_number INTEGER,
+            total_payments INTEGER,
+            pending_balance NUMERIC(12,2),
+            required_payment NUMERIC(12,2),
+            interest_rate VARCHAR(20),
+            status VARCHAR(10) NOT NULL DEFAULT 'open',
+            first_statement_date DATE NOT NULL,
+            last_statement_date DATE NOT NULL,
+            UNIQUE (operation_date, description, original_amount, seq)
+        );
+
+        CREATE TABLE IF NOT EXISTS msi_plan_event (
+            id_plan INTEGER NOT NULL REFERENCES msi_plan ON DELETE CASCADE,
+            statement_date DATE NOT NULL,
+            event VARCHAR(10) NOT NULL,
+            payment_number INTEGER,
+            pending_balance NUMERIC(12,2),
+            required_payment NUMERIC(12,2),
+            PRIMARY KEY (id_plan, statement_date)
+        );
+    """)
+
+def load_msi_plans(cursor, dfPlans):
+    """
+    Estado actual de los planes abiertos y de los que comparten llave con
+    dfPlans. Regresa un DataFrame con id_plan, MSI_PLAN_KEY, MSI_PLAN_STATE,
+    status y last_statement_date.
+    """
+    # Serializa el seguimiento entre cargas concurrentes de estados
+    cursor.execute("SELECT pg_advisory_xact_lock(%s);", (_lock_key("msi_plan"),))
+    keys = encode_columns(dfPlans, {"operation_date": "datetime", "description": "text", "original_amount": "float"})
+    cursor.execute(
+        f"""
+            SELECT id_plan, {', '.join(MSI_PLAN_KEY)}, {', '.join(MSI_PLAN_STATE)}, status, last_statement_date
+            FROM msi_plan
+            WHERE status = 'open'
+               OR (operation_date, description, original_amount) IN (
+                    SELECT * FROM unnest(%s::date[], %s::text[], %s::numeric[])
+               );
+        """,
+        (keys["operation_date"], keys["description"], keys["original_amount"])
+    )
+    columns = ["id_plan", *MSI_PLAN_KEY, *MSI_PLAN_STATE, "status", "last_statement_date"]
+    return pd.DataFrame(cursor.fetchall(), columns=columns)
+
+def apply_msi_plan_changes(cursor, dfNew, dfChanged, dfClosed, statementDate):
+    """
+    Escribe solo la actividad del estado: planes nuevos, planes con cambio de
+    estado (pago/saldo) y planes cerrados, más un evento por cada uno.
+    """
+    event_columns = ["id_plan", "event", "payment_number", "pending_balance", "required_payment"]
+    events = []
+    if len(dfNew):
+        df_new = dfNew.assign(first_statement_date=statementDate, last_statement_date=statementDate)
+        columns = MSI_PLAN_KEY + MSI_PLAN_STATE + ["status", "first_statement_date", "last_statement_date"]
+        inserted = execute_values(
+            cursor,
+            f"INSERT INTO msi_plan ({', '.join(columns)}) VALUES %s RETURNING id_plan;",
+            encode_rows(df_new[columns]),
+            fetch=True
+        )
+        events.append(df_new.assign(id_plan=[id_plan for id_plan, in inserted], event="new")[event_columns])
+    if len(dfChanged):
+        columns = ["id_plan"] + MSI_PLAN_STATE + ["status", "last_statement_date"]
+        execute_values(
+            cursor,
+            """
+                UPDATE msi_plan p SET
+                    payment_number = v.payment_number,
+                    total_payments = v.total_payments,
+                    pending_balance = v.pending_balance,
+                    required_payment = v.required_payment,
+                    interest_rate = v.interest_rate,
+                    status = v.status,
+                    last_statement_date = v.last_statement_date
+                FROM (VALUES %s) AS v(id_plan, payment_number, total_payments, pending_balance,
+                                      required_payment, interest_rate, status, last_statement_date)
+                WHERE p.id_plan = v.id_plan;
+            """,
+            encode_rows(dfChanged.assign(last_statement_date=statementDate)[columns]),
+            template="(%s::int, %s::int, %s::int, %s::numeric, %s::numeric, %s::text, %s::text, %s::date)"
+        )
+        events.append(dfChanged.assign(event="update")[event_columns])
+    if len(dfClosed):
+        closed_ids = [int(id_plan) for id_plan in dfClosed["id_plan"]]
+        cursor.execute(
+            "UPDATE msi_plan SET status = 'closed', last_statement_date = %s WHERE id_plan = ANY(%s);",
+            (statementDate, closed_ids)
+        )
+        events.append(pd.DataFrame({"id_plan": closed_ids, "event": "closed"}).reindex(columns=event_columns))
+    if events:
+        df_events = pd.concat(events, ignore_index=True).assign(statement_date=statementDate)
+        execute_values(
+            cursor,
+            f"""
+                INSERT INTO msi_plan_event ({', '.join(event_columns)}, statement_date)
+                VALUES %s
+                ON CONFLICT (id_plan, statement_date) DO NOTHING;
+            """,
+            encode_rows(df_events[event_columns + ["statement_date"]],
+                        {"id_plan": "int", "event": "text", "payment_number": "int",
+                         "pending_balance": "float", "required_payment": "float", "statement_date": "datetime"})
+        )
+    print_log(f"Planes MSI: {len(dfNew)} nuevos, {len(dfChanged)} con cambios, {len(dfClosed)} cerrados")
+    return len(dfNew), len(dfChanged), len(dfClosed)
 
 # Ejemplo de uso
 if __name__ == "__main__":
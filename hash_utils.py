@@ -0,0 +1,16 @@
+import hashlib
+
+# ==== HUELLAS DE CONTENIDO ====
+# Sin dependencias de base de datos: las usan tanto la ingesta como la extracción de PDF.
+
+def hash_file(filePath, chunkSize=1 << 20):
+    """SHA-256 del contenido de un archivo (leído por bloques)."""
+    digest = hashlib.sha256()
+    with open(filePath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunkSize), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_key(text):
+    """Huella bigint estable (blake2b de 8 bytes con signo) de un texto."""
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
@@ -1,29 +1,50 @@
+import argparse
 import numpy as np
 import os
 import pandas as pd
-import psycopg2
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from openpyxl import load_workbook
 # Importar funciones generales
+from hash_utils import hash_file, hash_key
 from utils_tools import (
     PROCESSED_DIR,
     ERRORS_DIR,
     print_log,
-    safe_convert_to_float,
-    move_file
+    move_file,
+    normalize_description,
+    encode_records,
+    encode_rows
 )
 # Importar funciones para DB
 from database_utils import (
-    DB_CONFIG,
     CAT_PAYMENT_TYPE,
     CAT_STORE,
+    get_connection,
     get_catalogs,
+    lock_catalogs,
+    load_product_index,
+    load_providers,
+    register_operation,
+    catalog_savepoint,
+    rollback_catalogs,
     get_id_payment_type,
     get_or_create_store,
     get_or_create_provider,
     create_product,
     insert_purchase,
     insert_operations,
-    insert_price
+    insert_price,
+    create_staging_tables,
+    bulk_insert_purchases,
+    bulk_insert_prices,
+    get_checkpoint,
+    save_checkpoint,
+    clear_checkpoint,
+    is_file_loaded,
+    load_row_hashes,
+    record_rows,
+    record_file,
+    verify_pending_providers
 )
 
 MARGEN_GANANCIA = 0.30  # 30% de margen de ganancia
@@ -32,6 +53,15 @@ DESCUENTO_OFERTA = 0.15  # 15% de descuento en ofertas
 # Habilitar/Dehabilitar LOGs
 ENABLE_LOGS = True
 
+# Ingesta masiva (staging + INSERT ... SELECT) en lugar de INSERT por fila
+BULK_INGESTION = True
+
+# Filas por transacción: cada bloque se confirma y se registra en ingestion_checkpoint
+CHUNK_SIZE = 500
+
+# Archivos procesados en paralelo (cada proceso con su propia conexión)
+INGESTION_WORKERS = 1
+
 # ==== DIRECTORIO DE ARCHIVOS ====
 DATA_DIR = "data_files_ingestion"
 
@@ -42,27 +72,116 @@ os.makedirs(ERRORS_DIR, exist_ok=True)
 # Mapeo de URLs
 PICTURE_URL = []
 
-def extract_hyperlinks(wb, sheetName="Precios", columna="Preview"):
-    """Versión modificada para trabajar con workbook ya abierto"""
-    try:
-        ws = wb[sheetName]
-        headers = [str(cell.value).strip() if cell.value else "" 
-                  for cell in next(ws.iter_rows(min_row=1, max_row=1))]
+# ==== ESQUEMA DE COLUMNAS ====
+# Tipo destino por columna: "float", "datetime" o "text"
+COMPRAS_SCHEMA = {
+    "Descripción": "text",
+    "Cant": "float",
+    "Precio": "float",
+    "% Desc": "float",
+    "C. Unit US": "float",
+    "C. Unit": "float",
+    "Total Cmpr": "float",
+    "Env US": "float",
+    "Envio": "float",
+    "Fch Cmpr": "datetime",
+    "Fch Entrga": "datetime",
+    "Euro": "float",
+    "Dólar": "float",
+    "Dsc US": "float",
+    "Desct": "float",
+    "Pzs": "float",
+    "Costo Final": "float",
+    "Liga": "text",
+    "TOTAL DESC": "float",
+    "Cmpr Final": "float",
+    "TOTAL CMPRS": "float",
+}
+PRECIOS_SCHEMA = {
+    "No": "float",
+    "Descripción": "text",
+    "Marca": "text",
+    "Categoria": "text",
+    "P. Tienda": "float",
+    "% Desc Cmpr": "float",
+    "Cant": "float",
+    "C. Unit": "float",
+    "Pzs": "float",
+    "Preview": "text",
+    "P. Venta": "float",
+    "P. Oferta": "float",
+    "Calc": "float",
+}
+# Textos que se consideran vacíos (comparación en minúsculas)
+NULL_TOKENS = ["", "none", "nan", "null"]
+# Marca de compra cancelada en "Fch Entrga"
+CANCELED_TOKEN = "CANCELED"
+# Columna con la llave normalizada de "Descripción" (cruce Compras/Precios)
+DESC_KEY = "desc_key"
+# Huella de cada compra (ledger ingestion_row): nombre de producto tal cual (como
+# create_product) más las columnas de operation_key, para que ambos filtros coincidan
+ROW_HASH = "row_hash"
+ROW_KEY_COLUMNS = ["Descripción", "Cant", "C. Unit", "Fch Cmpr"]
+
+def sheet_to_dataframe(ws, linkColumn=None):
+    """
+    Convierte una hoja ya abierta en DataFrame (primera fila = encabezados),
+    con las mismas reglas que pd.read_excel. Si se indica linkColumn, en la
+    misma pasada extrae el destino de sus hipervínculos.
+    """
+    rows = ws.iter_rows()
+    headers = [cell.value for cell in next(rows, ())]
+    link_idx = None
+    if linkColumn is not None:
         try:
-            col_idx = headers.index(columna) + 1
+            link_idx = [str(h).strip() if h else "" for h in headers].index(linkColumn)
         except ValueError:
-            print_log(f"⚠️ Columna '{columna}' no encontrada")
-            return [""] * (ws.max_row - 1)
-        urls = []
-        for row in ws.iter_rows(min_row=2, min_col=col_idx, max_col=col_idx):
-            cell = row[0]
-            url = cell.hyperlink.target if cell.hyperlink else ""
-            urls.append(url)
-        print_log(f"Extraídos {len(urls)} URLs")
-        return urls
-    except Exception as e:
-        print_log(f"❌ Error extrayendo hipervínculos: {str(e)}")
-        return []
+            print_log(f"⚠️ Columna '{linkColumn}' no encontrada")
+    data = []
+    urls = []
+    for row in rows:
+        # Celdas con error (#DIV/0!, #N/A...) se leen como vacías
+        data.append([cell.value if cell.data_type != "e" else None for cell in row])
+        if link_idx is not None:
+            cell = row[link_idx]
+            urls.append(cell.hyperlink.target if cell.hyperlink else "")
+    # Quitar filas vacías al final (celdas con formato pero sin datos)
+    while data and all(value is None for value in data[-1]):
+        data.pop()
+    # Quitar columnas vacías al final (sin encabezado ni datos)
+    width = len(headers)
+    while width and headers[width - 1] is None and all(row[width - 1] is None for row in data):
+        width -= 1
+    # Encabezados vacíos o repetidos como en read_excel ("Unnamed: n", "Col.1")
+    columns = []
+    seen = {}
+    for idx, header in enumerate(headers[:width]):
+        name = header if header is not None else f"Unnamed: {idx}"
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        columns.append(name)
+    df = pd.DataFrame([row[:width] for row in data], columns=columns, dtype=object)
+    df = df.fillna(np.nan).infer_objects()
+    if linkColumn is not None and link_idx is None:
+        urls = [""] * len(df)
+    return df, urls[:len(df)]
+
+def read_workbook(filePath, linkColumn="Preview"):
+    """
+    Lee el libro una sola vez: hojas "Compras" y "Precios" más los
+    hipervínculos de la columna Preview (openpyxl solo los expone fuera de read_only).
+    """
+    wb = load_workbook(filePath, data_only=True)
+    try:
+        df_prchss, _ = sheet_to_dataframe(wb["Compras"])
+        df_prices, links_urls = sheet_to_dataframe(wb["Precios"], linkColumn)
+        print_log(f"Extraídos {len(links_urls)} URLs")
+    finally:
+        wb.close()
+    return df_prchss, df_prices, links_urls
 
 def verify_columns(df, required_columns, df_name=""):
     """Verifica que un DataFrame tenga las columnas requeridas."""
@@ -72,6 +191,44 @@ def verify_columns(df, required_columns, df_name=""):
         return False
     return True
 
+def add_description_key(df):
+    """Agrega (si no existe) la llave normalizada de "Descripción"."""
+    if DESC_KEY not in df.columns:
+        df = df.copy()
+        df[DESC_KEY] = normalize_description(df["Descripción"])
+    return df
+
+def add_row_hash(df):
+    """
+    Agrega la huella bigint de cada compra (hash_key sobre ROW_KEY_COLUMNS:
+    descripción sin normalizar, números a 6 decimales y fecha AAAA-MM-DD). Se
+    guarda en la base, así que no depende de la versión de pandas.
+    """
+    df = df.copy()
+    parts = [df["Descripción"].astype("string").fillna("")]
+    for column in ("Cant", "C. Unit"):
+        parts.append(pd.to_numeric(df[column], errors="coerce").round(6).astype("string").fillna(""))
+    parts.append(pd.to_datetime(df["Fch Cmpr"], errors="coerce").dt.strftime("%Y-%m-%d").astype("string").fillna(""))
+    keys = parts[0].str.cat(parts[1:], sep="|")
+    df[ROW_HASH] = np.array([hash_key(key) for key in keys], dtype="int64")
+    return df
+
+def merge_on_description(dfLeft, dfRight, columns, name=""):
+    """
+    Left join por la llave normalizada de descripción en una sola pasada.
+    dfRight se deduplica por llave (gana la primera fila) para que el cruce
+    no multiplique filas; se reportan duplicados descartados y filas sin cruce.
+    """
+    right = dfRight[[DESC_KEY] + columns].dropna(subset=[DESC_KEY])
+    deduped = right.drop_duplicates(DESC_KEY, keep="first")
+    df = dfLeft.merge(deduped, on=DESC_KEY, how="left", validate="many_to_one", indicator=True)
+    misses = int(((df["_merge"] == "left_only") & df[DESC_KEY].notna()).sum())
+    print_log(
+        f"merge {name}: {len(df)} filas, {len(right) - len(deduped)} duplicados descartados, "
+        f"{misses} sin coincidencia"
+    )
+    return df.drop(columns="_merge")
+
 def procesar_purchase(dfPrchss, dfPrices):
     """Procesa el dataframe de purchase con manejo robusto de errores."""
     df = dfPrchss.copy()
@@ -88,12 +245,10 @@ def procesar_purchase(dfPrchss, dfPrices):
         df["Categoria"] = None
         return df
     try:
-        # Realizar el merge
-        print_log("df.merge()...")
-        df = df.merge(
-            dfPrices[["Descripción", "Marca", "Categoria"]], 
-            on="Descripción", 
-            how="left"
+        # Realizar el merge por la llave normalizada
+        print_log("merge_on_description()...")
+        df = merge_on_description(
+            add_description_key(df), add_description_key(dfPrices), ["Marca", "Categoria"], "Compras-Precios"
         )
         print_log(df[["Descripción", "Marca", "Categoria"]].head().to_string())
     except Exception as e:
@@ -104,193 +259,440 @@ def procesar_purchase(dfPrchss, dfPrices):
     return df
 
 def procesar_precios(dfPrices, dfPrchss):
-    """Procesa el dataframe de precios."""
-    df = dfPrices.copy()
-    print_log(f"df: {df}")
-    df['P. Tienda'] = df['P. Tienda'].astype(float)
-    df['C. Unit'] = df['C. Unit'].astype(float)
-    df = df.merge(
-        dfPrchss[["Descripción", "Cant", "% Desc", "Costo Final", "Pzs"]], 
-        on="Descripción", 
-        how="left"
-    )
-    print_log(f"df-updt: {df}")
+    """
+    Genera la tabla de precios indexada por la llave normalizada de descripción
+    (DESC_KEY) con los precios finales:
+    price = P. Venta (o Costo Final * (1 + MARGEN_GANANCIA) si viene vacío) y
+    offer_price = P. Oferta (o price * (1 - DESCUENTO_OFERTA) si viene vacía).
+    Se toma la primera fila de cada descripción en Precios y en Compras.
+    """
+    dfPrices = add_description_key(dfPrices)
+    empty = pd.Series(np.nan, index=dfPrices.index)
+    df = pd.DataFrame({
+        DESC_KEY: dfPrices[DESC_KEY],
+        "P. Venta": dfPrices.get("P. Venta", empty),
+        "P. Oferta": dfPrices.get("P. Oferta", empty),
+    })
+    df = merge_on_description(df, add_description_key(dfPrchss), ["Costo Final"], "Precios-Compras")
+    df = df.dropna(subset=[DESC_KEY]).drop_duplicates(DESC_KEY, keep="first").set_index(DESC_KEY)
+    # Cálculo vectorizado de precios (0 o vacío -> valor calculado)
+    p_venta = df["P. Venta"].astype(float)
+    p_oferta = df["P. Oferta"].astype(float)
+    df["price"] = p_venta.where(p_venta.fillna(0) != 0, df["Costo Final"] * (1 + MARGEN_GANANCIA))
+    df["offer_price"] = p_oferta.where(p_oferta.fillna(0) != 0, df["price"] * (1 - DESCUENTO_OFERTA))
+    df = df.dropna(subset=["price"])
+    print_log(f"Tabla de precios: {len(df)} descripciones")
     return df
 
-def deep_clean_data(df):
-    """Limpieza profunda de datos mejorada"""
-    #print_log(f"* df: {df}")
+def _null_tokens_mask(text):
+    return text.str.strip().str.lower().isin(NULL_TOKENS).fillna(False).astype(bool)
+
+def _clean_float(series):
+    """Columna numérica: acepta coma decimal y tokens vacíos."""
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype("float64")
+    text = series.astype("string")
+    text = text.mask(_null_tokens_mask(text)).str.strip().str.replace(",", ".", regex=False)
+    return pd.to_numeric(text, errors="coerce").astype("float64")
+
+def _clean_datetime(series):
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    return pd.to_datetime(series.astype(object), errors="coerce")
+
+def _clean_text(series):
+    """Columna de texto: object con None en vacíos."""
+    text = series.astype(object).where(series.notna(), None)
+    is_value = text.notna()
+    text[is_value] = text[is_value].astype(str)
+    return text.mask(_null_tokens_mask(text.astype("string")), None)
+
+def deep_clean_data(df, schema=None):
+    """
+    Limpieza vectorizada según el esquema de la hoja (COMPRAS_SCHEMA / PRECIOS_SCHEMA).
+    Devuelve un DataFrame tipado: float64 (NaN), datetime64 (NaT) y texto (None).
+    Las columnas fuera del esquema se tipan según su dtype leído.
+    """
+    schema = schema or {}
+    df = df.copy()
     for col in df.columns:
-        if pd.api.types.is_numeric_dtype(df[col]):
-            # Conversión segura para columnas numéricas
-            df[col] = df[col].apply(safe_convert_to_float)
-        elif pd.api.types.is_datetime64_any_dtype(df[col]):
-            # Manejo seguro de fechas
-            df[col] = pd.to_datetime(df[col], errors='coerce').apply(
-                lambda x: x.to_pydatetime() if pd.notna(x) else None
-            )
-    return df.replace([np.nan, pd.NA, 'None', 'none', 'NONE'], None)
-
-def data_ingestion(dfCompras, dfPrecios):
-    """Realiza la ingesta de datos a la base de datos."""
-    conn = psycopg2.connect(**DB_CONFIG)
-    success = True
+        col_type = schema.get(col)
+        if col_type is None:
+            if pd.api.types.is_numeric_dtype(df[col]):
+                col_type = "float"
+            elif pd.api.types.is_datetime64_any_dtype(df[col]):
+                col_type = "datetime"
+            else:
+                col_type = "text"
+        if col_type == "float":
+            df[col] = _clean_float(df[col])
+        elif col_type == "datetime":
+            df[col] = _clean_datetime(df[col])
+        else:
+            df[col] = _clean_text(df[col])
+    return df
+
+def resolve_links(dfCompras):
+    """Liga de cada compra: si la fila no trae liga se usa la de la fila anterior."""
+    links = []
+    previous_link = ""
+    for link in dfCompras.get("Liga", pd.Series([None] * len(dfCompras))):
+        links.append(link if link else previous_link)
+        previous_link = link
+    return links
+
+def prepare_row(cur, row, strLink, priceTable):
+    """
+    Resuelve tienda, proveedor y producto de una fila y arma sus datos de
+    compra, operación y precio. Regresa None si la fila se omite.
+    """
+    # Obtener o crear tienda y proveedor
+    print_log(f"str_link: {strLink}")
+    print_log("get_or_create_store()...")
+    id_store = get_or_create_store(cur, strLink)
+    if id_store is None:
+        return None
+    print_log(f"get_or_create_provider({id_store})...")
+    id_provider = get_or_create_provider(cur, id_store, strLink)
+    if id_provider is None:
+        return None
+    delivery_date = row.get("Fch Entrga")
+    print_log(f"* delivery_date: {delivery_date}")
+    if row.get("Cancelado") or (delivery_date is not None and CANCELED_TOKEN in str(delivery_date)):
+        return None
+    # Obtener o crear producto
+    product_name = row["Descripción"]
+    print_log(f"* product_name: {product_name}")
+    quantity = row["Cant"]
+    unit_price = row["C. Unit"]
+    if not product_name:
+        return None
+    purchase_date = row["Fch Cmpr"]
+    print_log(f"quantity: {quantity}, unit_price: {unit_price}, purchase_date: {purchase_date}")
+    print_log(f"create_product({product_name})...")
+    result = create_product(cur, row, product_name, "", quantity, unit_price, purchase_date)
+    print_log(f"result: {result}")
+
+    if not result["continue"]:
+        return None
+
+    id_product = result["id_product"]
+    id_payment_type = get_id_payment_type("Tarjeta de Crédito")
+    print_log(f"id_payment_type: {id_payment_type}")
+    # Preparar datos de compra
+    purchase_data = {
+        "id_provider": id_provider,
+        "id_payment_type": id_payment_type,
+        "total": row["Total Cmpr"],
+        "tax": 0,
+        "ieps": 0,
+        "purchase_date": row["Fch Cmpr"],
+        "delivery_date": delivery_date,
+        "exchange_rate": row.get("Dólar"),
+        "shipping_cost": row.get("Envio", 0),
+        "discount": row.get("Desct", 0)
+    }
+    # Preparar item de operación
+    operation_item = {
+        "quantity": row["Cant"],
+        "unit_price": row["C. Unit"],
+        "unit_price_usd":  row.get("C. Unit US"),
+        "discount_percentage": row.get("% Desc", 0),
+        "pieces_per_unit": row.get("Pzs", 1),
+        "final_cost": row.get("Costo Final"),
+        "product_url": row.get("Liga", "")
+    }
+    # Preparar precios si existe en la tabla de precios
+    price_data = None
+    if row.get(DESC_KEY) in priceTable:
+        price, offer_price = priceTable[row[DESC_KEY]]
+        print_log(f"price: {price}, offer_price: {offer_price}")
+        price_data = {
+            "price": price,
+            "offer_price": offer_price
+        }
+    # Registrar la operación para detectar duplicados dentro del mismo archivo
+    register_operation(id_product, quantity, unit_price, purchase_date)
+    return id_product, purchase_data, operation_item, price_data
+
+def insert_row(cur, idProduct, purchaseData, operationItem, priceData):
+    """Inserta compra, operación y precio de una fila (ingesta fila por fila)."""
+    print_log("insert_purchase()...")
+    id_purchase = insert_purchase(cur, purchaseData)
+    print_log(f"insert_operations({id_purchase})...")
+    insert_operations(cur, id_purchase, idProduct, [operationItem])
+    if priceData:
+        print_log(f"insert_price({idProduct})...")
+        insert_price(cur, idProduct, priceData)
+
+def insert_rows_isolated(cur, pending):
+    """
+    Inserta fila por fila, cada una en su SAVEPOINT.
+    pending: pares (fila, datos de prepare_row). Regresa los rechazos [(fila, error)].
+    """
+    rejected = []
+    for position, item in pending:
+        cur.execute("SAVEPOINT ingest_row;")
+        try:
+            insert_row(cur, *item)
+        except Exception as e:
+            cur.execute("ROLLBACK TO SAVEPOINT ingest_row;")
+            print_log(f"⚠️ Fila {position} rechazada: {e}")
+            rejected.append((position, str(e)))
+            continue
+        cur.execute("RELEASE SAVEPOINT ingest_row;")
+    return rejected
+
+def flush_pending(cur, pending):
+    """
+    Carga masiva de las filas del bloque (staging + INSERT ... SELECT). Si la
+    carga falla se deshace con su SAVEPOINT y se reintenta fila por fila para
+    aislar solo las filas con error. Regresa los rechazos [(fila, error)].
+    """
+    if not pending:
+        return []
+    purchase_rows = [
+        {**purchase_data, **operation_item, "id_product": id_product}
+        for _, (id_product, purchase_data, operation_item, _) in pending
+    ]
+    price_rows = [
+        {"id_product": id_product, **price_data}
+        for _, (id_product, _, _, price_data) in pending if price_data
+    ]
+    print_log(f"bulk_insert ({len(purchase_rows)} compras, {len(price_rows)} precios)...")
+    create_staging_tables(cur)
+    cur.execute("SAVEPOINT ingest_bulk;")
     try:
-        cur = conn.cursor()
-        # Inicializar catálogos
-        print_log("get_catalogs()...")
-        get_catalogs(cur)
-        previous_link = ""
-        # Procesar cada compra
-        for _, row in dfCompras.iterrows():
-            #print_log(f"* row: {row}")
-            # Obtener o crear tienda y proveedor
-            str_link = row.get("Liga")
-            print_log(f"str_link: {str_link}")
-            if not str_link:
-                print_log(f"previous_link: {previous_link}")
-                str_link = previous_link
-            previous_link = row.get("Liga")
-            print_log("get_or_create_store()...")
-            id_store = get_or_create_store(cur, str_link)
-            if id_store is None:
-                continue
-            print_log(f"get_or_create_provider({id_store})...")
-            id_provider = get_or_create_provider(cur, id_store, str_link)
-            if id_provider is None:
-                continue
-            delivery_date = row.get("Fch Entrga")
-            print_log(f"* delivery_date: {delivery_date}")
-            if delivery_date is not None and "CANCELED" in str(delivery_date):
-                continue
-            # Obtener o crear producto
-            product_name = row["Descripción"]
-            print_log(f"* product_name: {product_name}")
-            quantity = row["Cant"]
-            unit_price = row["C. Unit"]
-            if not product_name or not product_name:
-                continue
-            purchase_date = row["Fch Cmpr"]
-            print_log(f"quantity: {quantity}, unit_price: {unit_price}, purchase_date: {purchase_date}")
-            print_log(f"create_product({product_name})...")
-            result = create_product(cur, row, product_name, "", quantity, unit_price, purchase_date)
-            print_log(f"result: {result}")
-
-            if not result["continue"]:
-                continue
-
-            id_product = result["id_product"]
-            id_payment_type = get_id_payment_type("Tarjeta de Crédito")
-            print_log(f"id_payment_type: {id_payment_type}")
-            # Preparar datos de compra
-            purchase_data = {
-                "id_provider": id_provider,
-                "id_payment_type": id_payment_type,
-                "total": row["Total Cmpr"],
-                "tax": 0,
-                "ieps": 0,
-                "purchase_date": row["Fch Cmpr"],
-                "delivery_date": delivery_date,
-                "exchange_rate": row.get("Dólar"),
-                "shipping_cost": row.get("Envio", 0),
-                "discount": row.get("Desct", 0)
-            }
-            # Insertar compra
-            print_log("insert_purchase()...")
-            id_purchase = insert_purchase(cur, purchase_data)
-            # Preparar items de operación
-            operation_items = [{
-                "quantity": row["Cant"],
-                "unit_price": row["C. Unit"],
-                "unit_price_usd":  row.get("C. Unit US"),
-                "discount_percentage": row.get("% Desc", 0),
-                "pieces_per_unit": row.get("Pzs", 1),
-                "final_cost": row.get("Costo Final"),
-                "product_url": row.get("Liga", "")
-            }]
-            print_log(f"insert_operations({id_purchase})...")
-            insert_operations(cur, id_purchase, id_product, operation_items)
-            # Insertar precios si existe en el df de precios
-            if row["Descripción"] in dfPrecios["Descripción"].values:
-                price_row = dfPrecios[dfPrecios["Descripción"] == row["Descripción"]].iloc[0]
-                operation = operation_items[0]
-                price = price_row["P. Venta"]
-                price = price if price else float(operation["final_cost"])*float(1+MARGEN_GANANCIA)
-                offer_price = price_row.get("P. Oferta")
-                offer_price = offer_price if offer_price else price*float(1-DESCUENTO_OFERTA)
-                print_log(f"price: {price}, offer_price: {offer_price}")
-                price_data = {
-                    "price": price,
-                    "offer_price": offer_price
-                }
-                print_log(f"insert_price({id_product})...")
-                insert_price(cur, id_product, price_data)
-        print("conn.commit()...")
-        conn.commit()
-        print("✅ Datos ingresados correctamente.")
+        bulk_insert_purchases(cur, purchase_rows)
+        bulk_insert_prices(cur, price_rows)
     except Exception as e:
-        print("conn.rollback()...")
-        conn.rollback()
-        print(f"❌ Error en la ingesta de datos: {e}")
-        success = False
-    finally:
-        conn.close()
-        return success
+        cur.execute("ROLLBACK TO SAVEPOINT ingest_bulk;")
+        print_log(f"⚠️ Carga masiva del bloque fallida ({e}), reintentando fila por fila...")
+        return insert_rows_isolated(cur, pending)
+    cur.execute("RELEASE SAVEPOINT ingest_bulk;")
+    return []
+
+def ingest_chunk(cur, rows, priceTable, bulk):
+    """
+    Procesa un bloque de filas dentro de la transacción abierta (sin commit).
+    rows: ternas (fila, registro, liga). Cada fila corre en su SAVEPOINT: si
+    falla se deshace en la base y en los catálogos en memoria, y queda como
+    rechazo. Regresa (filas insertadas, rechazos [(fila, error)]).
+    """
+    names = [row["Descripción"] for _, row, _ in rows]
+    links = [link for _, _, link in rows]
+    # Bloquear catálogos del bloque antes de leerlos (los locks se liberan en cada commit)
+    print_log("lock_catalogs()...")
+    lock_catalogs(cur, dict.fromkeys(links), names)
+    # Recargar catálogos: otro proceso pudo crear registros desde el bloque anterior
+    print_log("get_catalogs()...")
+    get_catalogs(cur)
+    print_log("load_product_index()...")
+    load_product_index(cur, names)
+    # Resolver tiendas y precargar/crear proveedores del bloque
+    store_urls = [(get_or_create_store(cur, link), link) for link in dict.fromkeys(links)]
+    print_log("load_providers()...")
+    load_providers(cur, store_urls)
+    inserted = []
+    rejected = []
+    pending = []
+    for position, row, str_link in rows:
+        marks = catalog_savepoint()
+        cur.execute("SAVEPOINT ingest_row;")
+        try:
+            item = prepare_row(cur, row, str_link, priceTable)
+            if item is not None and not bulk:
+                insert_row(cur, *item)
+        except Exception as e:
+            cur.execute("ROLLBACK TO SAVEPOINT ingest_row;")
+            rollback_catalogs(marks)
+            print_log(f"⚠️ Fila {position} rechazada: {e}")
+            rejected.append((position, str(e)))
+            continue
+        cur.execute("RELEASE SAVEPOINT ingest_row;")
+        if item is None:
+            continue
+        if bulk:
+            pending.append((position, item))
+        else:
+            inserted.append(position)
+    if bulk:
+        bulk_rejected = flush_pending(cur, pending)
+        failed = {position for position, _ in bulk_rejected}
+        inserted += [position for position, _ in pending if position not in failed]
+        rejected += bulk_rejected
+    return inserted, rejected
+
+def save_rejected_rows(dfCompras, rejected, fileName):
+    """Agrega las filas rechazadas (con su error) al archivo de rechazos en ERRORS_DIR."""
+    if not rejected:
+        return None
+    positions, errors = zip(*rejected)
+    df_rejected = dfCompras.iloc[list(positions)].drop(columns=[DESC_KEY, ROW_HASH], errors="ignore")
+    df_rejected.insert(0, "fila", positions)
+    df_rejected["error"] = errors
+    base = os.path.splitext(fileName or "ingesta")[0]
+    path = os.path.join(ERRORS_DIR, f"{base}_rechazadas.csv")
+    df_rejected.to_csv(path, mode="a", header=not os.path.exists(path), index=False)
+    print_log(f"{len(rejected)} filas rechazadas -> {path}")
+    return path
+
+def data_ingestion(dfCompras, dfPrecios, bulk=BULK_INGESTION, fileName=None, chunkSize=CHUNK_SIZE, fileHash=None):
+    """
+    Realiza la ingesta de datos a la base de datos en bloques de chunkSize
+    filas, con un commit por bloque. Las compras cuya huella ya está en
+    ingestion_row se descartan antes de insertar (anti-join en una consulta).
+    Las filas con error se rechazan solas (SAVEPOINT por fila) y se guardan en
+    el archivo de rechazos. Con fileName el avance queda en
+    ingestion_checkpoint: si la ingesta se interrumpe, una nueva corrida del
+    archivo continúa después del último bloque confirmado. Con fileHash, al
+    terminar el archivo queda registrado en ingestion_file.
+    """
+    # Precios finales por descripción (tabla generada por procesar_precios)
+    price_table = dict(zip(
+        dfPrecios.index,
+        encode_rows(dfPrecios, {"price": "float", "offer_price": "float"})
+    ))
+    success = True
+    with get_connection() as conn:
+        try:
+            cur = conn.cursor()
+            dfCompras = add_row_hash(dfCompras)
+            links = resolve_links(dfCompras)
+            # Filas con valores nativos (NaN/NaT -> None), codificadas por columna
+            records = encode_records(dfCompras.drop(columns=[ROW_HASH]))
+            row_hashes = dfCompras[ROW_HASH].to_numpy()
+            first_row = 0
+            if fileName:
+                first_row = get_checkpoint(cur, fileName, fileHash)[0] + 1
+                if first_row:
+                    print(f"Reanudando {fileName} desde la fila {first_row} de {len(records)}")
+            # Anti-join contra el ledger: solo quedan las compras no cargadas
+            loaded = dfCompras[ROW_HASH].isin(load_row_hashes(cur, row_hashes)).to_numpy(copy=True)
+            loaded[:first_row] = True
+            positions = np.flatnonzero(~loaded).tolist()
+            print_log(f"Filas por cargar: {len(positions)} de {len(records)}")
+            conn.commit()
+            rejected_count = 0
+            for start in range(0, len(positions), chunkSize):
+                chunk = positions[start:start + chunkSize]
+                print_log(f"Bloque {chunk[0]}-{chunk[-1]}...")
+                inserted, rejected = ingest_chunk(
+                    cur, [(pos, records[pos], links[pos]) for pos in chunk], price_table, bulk
+                )
+                record_rows(cur, fileHash, row_hashes[inserted].tolist())
+                if fileName:
+                    save_checkpoint(cur, fileName, chunk[-1], len(rejected), fileHash)
+                print("conn.commit()...")
+                conn.commit()
+                save_rejected_rows(dfCompras, rejected, fileName)
+                rejected_count += len(rejected)
+            # Archivo terminado: sin avance pendiente y, si no hubo rechazos en
+            # ninguna corrida (las reanudadas no reintentan los de corridas
+            # anteriores), registrado en el ledger para omitirlo la próxima vez
+            if fileName:
+                rejected_count = get_checkpoint(cur, fileName, fileHash)[1]
+                clear_checkpoint(cur, fileName)
+            if fileHash and not rejected_count:
+                record_file(cur, fileHash, fileName, len(records))
+            conn.commit()
+            if rejected_count:
+                print(f"⚠️ Datos ingresados con {rejected_count} filas rechazadas.")
+            else:
+                print("✅ Datos ingresados correctamente.")
+        except Exception as e:
+            print("conn.rollback()...")
+            conn.rollback()
+            print(f"❌ Error en la ingesta de datos: {e}")
+            success = False
+    return success
 
 def procesar_archivo(filePath):
     """Procesa un archivo Excel y realiza la ingesta."""
     print(f"Procesando archivo: {filePath}")
     success = False
-    xls = None
-    wb = None
+    retry = False
     try:
-        print("extract_hyperlinks()...")
-        # Extraer hipervínculos con manejo explícito del archivo
-        with open(filePath, 'rb') as f:
-            wb = load_workbook(f, data_only=True)
-            links_urls = extract_hyperlinks(wb)  # Modificar extract_hyperlinks para aceptar wb
-        # Leer datos con pandas asegurando cierre del archivo
-        with pd.ExcelFile(filePath) as xls:
-            df_prchss = pd.read_excel(xls, "Compras")
-            df_prices = pd.read_excel(xls, "Precios")
+        # Un archivo con el mismo contenido ya cargado se omite sin leerlo
+        file_hash = hash_file(filePath)
+        if is_file_loaded(file_hash):
+            print(f"Archivo ya cargado (sin cambios), se omite: {filePath}")
+            success = True
+            return success
+        print("read_workbook()...")
+        df_prchss, df_prices, links_urls = read_workbook(filePath)
+        # Compras canceladas (se marca antes de tipar "Fch Entrga" como fecha)
+        df_prchss["Cancelado"] = df_prchss.get("Fch Entrga", pd.Series(index=df_prchss.index, dtype=object)) \
+            .astype("string").str.contains(CANCELED_TOKEN, regex=False).fillna(False).astype(bool)
         # Limpieza profunda
         print("deep_clean_data()...")
-        df_prchss_cln = deep_clean_data(df_prchss)
-        df_prices_cln = deep_clean_data(df_prices)
+        df_prchss_cln = deep_clean_data(df_prchss, COMPRAS_SCHEMA)
+        df_prices_cln = deep_clean_data(df_prices, PRECIOS_SCHEMA)
         print_log(f"df_prices_cln-len: {len(df_prices_cln)}")
-        df_prchss_cln["Picture_URL"] = links_urls[:len(df_prchss_cln)]
-        print_log(f"Picture_URL: {len(df_prchss_cln["Picture_URL"])}")
+        links_urls = links_urls[:len(df_prchss_cln)]
+        df_prchss_cln["Picture_URL"] = links_urls + [""] * (len(df_prchss_cln) - len(links_urls))
+        print_log(f"Picture_URL: {len(df_prchss_cln['Picture_URL'])}")
+        # Llave normalizada de descripción (una sola vez por hoja)
+        df_prchss_cln = add_description_key(df_prchss_cln)
+        df_prices_cln = add_description_key(df_prices_cln)
         print("procesar_purchase()...")
         df_prchss_upd = procesar_purchase(df_prchss_cln, df_prices_cln)
         print("procesar_precios()...")
         df_prices_upd = procesar_precios(df_prices_cln, df_prchss_cln)
         # Procesar ingesta
-        success = data_ingestion(df_prchss_upd, df_prices_upd)
+        success = data_ingestion(df_prchss_upd, df_prices_upd,
+                                 fileName=os.path.basename(filePath), fileHash=file_hash)
+        # Con filas rechazadas (en esta corrida o en una anterior) el archivo no
+        # queda en ingestion_file: se deja en DATA_DIR para reintentarlas
+        retry = success and not is_file_loaded(file_hash)
     except Exception as e:
-        print(f"❌ Error procesando archivo {file_path}: {e}")
+        print(f"❌ Error procesando archivo {filePath}: {e}")
         success = False
     finally:
-        # Cerrar explícitamente los recursos
-        if wb is not None:
-            wb.close()
-        if xls is not None and hasattr(xls, 'close'):
-            xls.close()
-        # Mover el archivo solo después de cerrar todos los recursos
-        move_file(filePath, success=success)
+        if retry:
+            print(f"⚠️ {filePath} tiene filas rechazadas: se deja en {DATA_DIR} para reintentarlas")
+        else:
+            # Mover el archivo (read_workbook ya cerró el libro)
+            move_file(filePath, success=success)
         return success
 
 # ==== MAIN ====
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingesta de archivos XLSX a Postgres")
+    parser.add_argument("--workers", type=int, default=INGESTION_WORKERS,
+                        help="Número de archivos procesados en paralelo")
+    args = parser.parse_args()
     # Procesar todos los archivos XLSX en el directorio
     processed_count = 0
     error_count = 0
-    for file_name in os.listdir(DATA_DIR):
-        if file_name.endswith(".xlsx"):
-            file_path = os.path.join(DATA_DIR, file_name)
+    file_paths = [
+        os.path.join(DATA_DIR, file_name)
+        for file_name in sorted(os.listdir(DATA_DIR))
+        if file_name.endswith(".xlsx")
+    ]
+    if args.workers > 1:
+        print(f"Procesando {len(file_paths)} archivos con {args.workers} procesos...")
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = {executor.submit(procesar_archivo, file_path): file_path for file_path in file_paths}
+            for future in as_completed(futures):
+                try:
+                    success = future.result()
+                except Exception as e:
+                    print(f"❌ Error en el proceso de {futures[future]}: {e}")
+                    success = False
+                if success:
+                    processed_count += 1
+                else:
+                    error_count += 1
+    else:
+        for file_path in file_paths:
             if procesar_archivo(file_path):
                 processed_count += 1
             else:
                 error_count += 1
+    # Verificación de proveedores nuevos fuera de la transacción de ingesta
+    print("verify_pending_providers()...")
+    verify_pending_providers()
     print(f"\n✅ Proceso de ingesta completado.")
     print(f"Archivos procesados correctamente: {processed_count}")
     print(f"Archivos con errores: {error_count}")
@@ -1,145 +1,638 @@
+import argparse
+import importlib.util
 import os
 import re
+import time
 import pandas as pd
 import fitz  # PyMuPDF
+import xlsxwriter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
+from hash_utils import hash_file
 
 # Rutas base del proyecto
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_IMPORT_DIR = os.path.join(BASE_DIR, "pdf_files")
 OUTPUT_DIR = os.path.join(BASE_DIR, "pdf_to_xlsx_files")
+CACHE_DIR = os.path.join(BASE_DIR, "pdf_cache")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 # === Configuración ===
 base_output = "cargos_bbva"
 #pdf_file = "Estado_Cuenta.pdf"
 pdf_file = "EdoCuentaSep25.pdf"
+# Estados de cuenta convertidos en paralelo (1 = secuencial)
+CONVERSION_WORKERS = os.cpu_count() or 1
+# Versión del parser: incrementarla al cambiar la extracción invalida el cache
+PARSER_VERSION = 3
+# Modo de extracción: "text" (regex sobre el texto) o "layout" (coordenadas de palabras)
+EXTRACTION_MODE = "text"
+# Formato de salida: "xlsx", "parquet" o "csv"
+OUTPUT_FORMAT = "xlsx"
+
+# === Patrones de extracción ===
+# Patrón para Meses Sin Intereses
+MSI_PATTERN = re.compile(
+    r"(\d{2}-[a-z]{3}-\d{4})\s+(.+?)\s+\$([\d,]+\.\d{2})\s+\$([\d,]+\.\d{2})\s+\$([\d,]+\.\d{2})\s+(\d+ de \d+)\s+([\d.]+%)",
+    re.IGNORECASE
+)
+
+# Patrón para Compras Regulares
+COMPRAS_PATTERN = re.compile(
+    r"(\d{2}-[a-z]{3}-\d{4})\s+(\d{2}-[a-z]{3}-\d{4})\s+(.+?)\s+([+-]\s*\$?[\d,]+\.\d{2})",
+    re.IGNORECASE
+)
+
+# Secciones del estado de cuenta: nombre -> (marca de inicio, marca de fin, patrón de fila)
+SECTIONS = {
+    "msi": (
+        re.compile(re.escape("COMPRAS Y CARGOS DIFERIDOS A MESES SIN INTERESES"), re.IGNORECASE),
+        re.compile(re.escape("COMPRAS Y CARGOS DIFERIDOS A MESES CON INTERESES"), re.IGNORECASE),
+        MSI_PATTERN,
+    ),
+    "compras": (
+        re.compile(re.escape("CARGOS,COMPRAS Y ABONOS REGULARES(NO A MESES)"), re.IGNORECASE),
+        re.compile(re.escape("TOTAL CARGOS"), re.IGNORECASE),
+        COMPRAS_PATTERN,
+    ),
+}
+
+def iter_statement_rows(doc):
+    """
+    Recorre el PDF página por página y genera (sección, grupos) por cada fila
+    encontrada, sin construir el texto completo del documento.
+
+    Cada sección es una máquina de estados (pendiente -> dentro -> terminada):
+    mientras está pendiente solo se busca la marca de inicio; dentro, el buffer
+    guarda lo que queda después de la última fila emitida (una fila partida entre
+    páginas se completa con la siguiente). Se procesa la primera aparición de
+    cada sección, como el re.search original, y se deja de leer el PDF en cuanto
+    ambas secciones terminan.
+    """
+    state = {name: "pending" for name in SECTIONS}
+    buffer = {name: "" for name in SECTIONS}
+
+    for page in doc:
+        page_text = page.get_text() + "\n"
+        for name, (start_re, end_re, row_re) in SECTIONS.items():
+            if state[name] == "done":
+                continue
+            text = buffer[name] + page_text
+            if state[name] == "pending":
+                start = start_re.search(text)
+                if not start:
+                    # Conservar la cola por si la marca queda partida entre páginas
+                    buffer[name] = text[-len(start_re.pattern):]
+                    continue
+                state[name] = "inside"
+                text = text[start.end():]
+
+            end = end_re.search(text)
+            if end:
+                text = text[:end.start()]
+                state[name] = "done"
+
+            last_end = 0
+            for match in row_re.finditer(text):
+                last_end = match.end()
+                yield name, match.groups()
+            buffer[name] = "" if state[name] == "done" else text[last_end:]
+
+        if all(value == "done" for value in state.values()):
+            break
+
+# === Extracción por coordenadas (modo layout) ===
+# Columnas numéricas de cada sección: (campo, palabra del encabezado que la ancla).
+# "dates" es el número de fechas con las que inicia cada fila.
+LAYOUT_COLUMNS = {
+    "msi": {
+        "dates": 1,
+        "columns": [("monto_orig", "Monto"), ("saldo_pend", "Saldo"), ("pago_req", "Pago"),
+                    ("num_pago", "Núm."), ("tasa", "Tasa")],
+    },
+    "compras": {
+        "dates": 2,
+        "columns": [("monto", "Monto")],
+    },
+}
+DATE_WORD = re.compile(r"\d{2}-[a-z]{3}-\d{4}$", re.IGNORECASE)
+LINE_TOLERANCE = 3   # pts en y para considerar dos palabras en la misma línea
+COLUMN_PAD = 30      # pts a cada lado del encabezado que abarca una columna numérica
+MAX_WRAP_GAP = 20    # pts máximos entre una fila y su línea de continuación
+
+def _page_lines(page):
+    """Agrupa las palabras de la página en líneas (por y) ordenadas por x."""
+    lines = []
+    for word in sorted(page.get_text("words"), key=lambda w: (w[3], w[0])):
+        if lines and word[3] - lines[-1][0] <= LINE_TOLERANCE:
+            lines[-1][1].append(word)
+        else:
+            lines.append((word[3], [word]))
+    return [(y, sorted(words, key=lambda w: w[0])) for y, words in lines]
+
+def _layout_row_groups(name, row):
+    """Convierte una fila armada por columnas a la tupla de grupos del modo texto."""
+    values = {field: " ".join(words) for field, words in row["columns"].items()}
+    descripcion = " ".join(row["description"])
+    if name == "msi":
+        amounts = [values.get(field, "").lstrip("$") for field in ("monto_orig", "saldo_pend", "pago_req")]
+        if not descripcion or not all(re.fullmatch(r"[\d,]+\.\d{2}", a) for a in amounts):
+            return None
+        return (*row["dates"], descripcion, *amounts, values.get("num_pago", ""), values.get("tasa", ""))
+    monto = values.get("monto", "")
+    if not descripcion or not re.fullmatch(r"[+-]\s*\$?[\d,]+\.\d{2}", monto):
+        return None
+    return (*row["dates"], descripcion, monto)
+
+def iter_statement_rows_layout(doc):
+    """
+    Variante de iter_statement_rows que arma las filas con las coordenadas de
+    las palabras (page.get_text("words")) en lugar de regex sobre el texto.
+
+    Las líneas se agrupan por y; una línea que inicia con fecha abre una fila y
+    cada palabra posterior cae en la columna numérica cuyo encabezado (más
+    COLUMN_PAD) contiene su centro, o en la descripción. Las líneas siguientes
+    sin fecha (a menos de MAX_WRAP_GAP) son descripciones partidas y se agregan
+    a la fila abierta mientras le falten montos; una vez completa, las líneas de
+    detalle se ignoran, como en el modo texto. Las secciones se siguen de forma independiente, igual que
+    en el modo texto, y se generan (sección, grupos) con la misma forma para
+    reutilizar la conversión de valores.
+    """
+    state = {name: "pending" for name in SECTIONS}
+    spans = {name: {} for name in SECTIONS}
 
-def extraer_datos_bbva():
-    # Construir rutas completas
-    pdf_path = os.path.join(DATA_IMPORT_DIR, pdf_file)
-    
-    # Verificar que el archivo PDF existe
-    if not os.path.exists(pdf_path):
-        raise FileNotFoundError(f"No se encontró el archivo PDF: {pdf_path}")
-    
-    # Abrir el PDF
-    doc = fitz.open(pdf_path)
-    text = ""
     for page in doc:
-        text += page.get_text() + "\n"
+        # Las filas no cruzan páginas: fila abierta y su última y por sección
+        rows = {name: None for name in SECTIONS}
+        last_y = {name: None for name in SECTIONS}
+        for y, words in _page_lines(page):
+            line_text = " ".join(w[4] for w in words)
+            for name, (start_re, end_re, _) in SECTIONS.items():
+                if state[name] == "pending":
+                    if start_re.search(line_text):
+                        state[name] = "inside"
+                    continue
+                if state[name] == "done":
+                    continue
+                layout = LAYOUT_COLUMNS[name]
+                row = rows[name]
+
+                if end_re.search(line_text):
+                    if row and (groups := _layout_row_groups(name, row)):
+                        yield name, groups
+                    rows[name], state[name] = None, "done"
+                    continue
+
+                n_dates = layout["dates"]
+                line_words = words
+                if len(words) > n_dates and all(DATE_WORD.match(w[4]) for w in words[:n_dates]):
+                    if row and (groups := _layout_row_groups(name, row)):
+                        yield name, groups
+                    row = rows[name] = {"dates": [w[4] for w in words[:n_dates]], "description": [], "columns": {}}
+                    line_words = words[n_dates:]
+                elif row is None or y - last_y[name] > MAX_WRAP_GAP:
+                    # Fuera de fila: encabezados de columnas, títulos o pies de página
+                    if row and (groups := _layout_row_groups(name, row)):
+                        yield name, groups
+                    rows[name] = None
+                    anchors = {anchor: field for field, anchor in layout["columns"]}
+                    for w in words:
+                        if w[4] in anchors:
+                            spans[name][anchors[w[4]]] = (w[0] - COLUMN_PAD, w[2] + COLUMN_PAD, (w[0] + w[2]) / 2)
+                    continue
+                elif all(field in row["columns"] for field, _ in layout["columns"]):
+                    # Fila completa (ya tiene sus montos): lo que sigue son líneas de detalle
+                    # (IVA/intereses, tipo de cambio) que el modo texto tampoco incluye
+                    last_y[name] = y
+                    continue
+
+                # Columna numérica con el centro más cercano o, si no cae en ninguna, descripción
+                for w in line_words:
+                    center = (w[0] + w[2]) / 2
+                    fields = [(abs(center - c), field) for field, (x0, x1, c) in spans[name].items() if x0 <= center <= x1]
+                    if fields:
+                        row["columns"].setdefault(min(fields)[1], []).append(w[4])
+                    else:
+                        row["description"].append(w[4])
+                last_y[name] = y
+
+        for name, row in rows.items():
+            if row and (groups := _layout_row_groups(name, row)):
+                yield name, groups
+        if all(value == "done" for value in state.values()):
+            break
+
+# === Conversión de valores ===
+# Meses en español del estado de cuenta (independiente del locale, a diferencia de %b)
+SPANISH_MONTHS = {
+    "ene": 1, "feb": 2, "mar": 3, "abr": 4, "may": 5, "jun": 6,
+    "jul": 7, "ago": 8, "sep": 9, "oct": 10, "nov": 11, "dic": 12,
+}
+MSI_COLUMNS = ["Fecha operación", "Descripción", "Monto original", "Saldo pendiente",
+               "Pago requerido", "Núm. de pago", "Tasa de interés aplicable"]
+COMPRAS_COLUMNS = ["Fecha de la operación", "Fecha de cargo", "Pago requerido", "Descripción"]
+
+def parse_fechas(series):
+    """Convierte fechas "dd-mmm-aaaa" (mes en español) a datetime64; inválidas -> NaT."""
+    parts = series.astype("string").str.lower().str.extract(r"^(\d{2})-([a-z]{3})-(\d{4})$")
+    # Se arma "aaaa-mm-dd" y se convierte con coerce: día/año fuera de rango o mes desconocido -> NaT
+    iso = parts[2] + "-" + parts[1].map(SPANISH_MONTHS).astype("Int64").astype("string").str.zfill(2) + "-" + parts[0]
+    dates = pd.to_datetime(iso, format="%Y-%m-%d", errors="coerce")
+    # Años fuera del rango de datetime64[ns] también quedan como NaT
+    dates = dates.where(dates.between(pd.Timestamp.min, pd.Timestamp.max))
+    return dates.astype("datetime64[ns]")
+
+def parse_montos(series):
+    """Convierte montos "$1,234.56" / "+ $230.00" / "- $30.38" a float64 con signo."""
+    return pd.to_numeric(
+        series.astype("string").str.replace(r"[\s$,]", "", regex=True), errors="coerce"
+    ).astype("float64")
+
+def _extraer_secciones(pdf_path, mode=EXTRACTION_MODE):
+    """
+    Extrae (df_msi, df_compras) del PDF con PyMuPDF (modo "text" o "layout").
+    Los grupos crudos se juntan por columna y se convierten en un solo paso, así
+    que las fechas siempre son datetime64 y los montos float64.
+    """
+    iter_rows = iter_statement_rows_layout if mode == "layout" else iter_statement_rows
+    # Inicializar listas para almacenar los grupos crudos
+    raw = {"msi": [], "compras": []}
     
-    # Inicializar listas para almacenar datos
-    msi_data = []  # Meses sin intereses
-    compras_data = []  # Compras regulares
-    compras_fechas = []  # Para almacenar fechas de operación
+    # Abrir el PDF y recorrer las filas de ambas secciones en streaming
+    with fitz.open(pdf_path) as doc:
+        for section, groups in iter_rows(doc):
+            raw[section].append(groups)
     
-    # Patrones de regex para extraer datos
-    # Patrón para Meses Sin Intereses
-    msi_pattern = re.compile(
-        r"(\d{2}-[a-z]{3}-\d{4})\s+(.+?)\s+\$([\d,]+\.\d{2})\s+\$([\d,]+\.\d{2})\s+\$([\d,]+\.\d{2})\s+(\d+ de \d+)\s+([\d.]+%)",
-        re.IGNORECASE
-    )
+    # Meses Sin Intereses
+    df_msi = pd.DataFrame(raw["msi"], columns=MSI_COLUMNS, dtype="string")
+    df_msi["Fecha operación"] = parse_fechas(df_msi["Fecha operación"])
+    for column in ["Monto original", "Saldo pendiente", "Pago requerido"]:
+        df_msi[column] = parse_montos(df_msi[column])
     
-    # Patrón para Compras Regulares
-    compras_pattern = re.compile(
-        r"(\d{2}-[a-z]{3}-\d{4})\s+(\d{2}-[a-z]{3}-\d{4})\s+(.+?)\s+([+-]\s*\$?[\d,]+\.\d{2})",
-        re.IGNORECASE
+    # Compras Regulares (los grupos vienen como fecha, fecha, descripción, monto)
+    df_compras = pd.DataFrame(
+        raw["compras"], columns=["Fecha de la operación", "Fecha de cargo", "Descripción", "Pago requerido"],
+        dtype="string",
     )
+    for column in ["Fecha de la operación", "Fecha de cargo"]:
+        df_compras[column] = parse_fechas(df_compras[column])
+    df_compras["Pago requerido"] = parse_montos(df_compras["Pago requerido"])
     
-    # Buscar secciones en el texto
-    msi_section = re.search(r"COMPRAS Y CARGOS DIFERIDOS A MESES SIN INTERESES(.+?)COMPRAS Y CARGOS DIFERIDOS A MESES CON INTERESES", text, re.DOTALL | re.IGNORECASE)
-    compras_section = re.search(r"CARGOS,COMPRAS Y ABONOS REGULARES\(NO A MESES\)(.+?)TOTAL CARGOS", text, re.DOTALL | re.IGNORECASE)
-    
-    # Procesar Meses Sin Intereses
-    if msi_section:
-        msi_text = msi_section.group(1)
-        for match in msi_pattern.finditer(msi_text):
-            fecha_str, descripcion, monto_orig, saldo_pend, pago_req, num_pago, tasa = match.groups()
-            
-            # Convertir fecha
-            try:
-                fecha = datetime.strptime(fecha_str, "%d-%b-%Y")
-            except:
-                fecha = fecha_str
-            
-            # Limpiar valores numéricos
-            monto_orig = float(monto_orig.replace(",", "").replace("$", ""))
-            saldo_pend = float(saldo_pend.replace(",", "").replace("$", ""))
-            pago_req = float(pago_req.replace(",", "").replace("$", ""))
-            
-            msi_data.append([fecha, descripcion, monto_orig, saldo_pend, pago_req, num_pago, tasa])
-    
-    # Procesar Compras Regulares
-    if compras_section:
-        compras_text = compras_section.group(1)
-        for match in compras_pattern.finditer(compras_text):
-            fecha_oper, fecha_cargo, descripcion, monto = match.groups()
-            
-            # Convertir fechas
-            try:
-                fecha_oper_dt = datetime.strptime(fecha_oper, "%d-%b-%Y")
-                compras_fechas.append(fecha_oper_dt)  # Guardar para encontrar la fecha máxima
-                fecha_oper = fecha_oper_dt
-            except:
-                fecha_oper_dt = None
-                pass
-                
-            try:
-                fecha_cargo = datetime.strptime(fecha_cargo, "%d-%b-%Y")
-            except:
-                pass
-            
-            # Limpiar monto
-            monto_clean = monto.replace("+", "").replace(" ", "").replace("$", "").replace(",", "")
-            try:
-                monto_valor = float(monto_clean)
-                # Restaurar signo negativo si existe
-                if "-" in monto:
-                    monto_valor = -abs(monto_valor)
-            except:
-                monto_valor = monto
-            
-            compras_data.append([fecha_oper, fecha_cargo, monto_valor, descripcion])
-    
-    # Determinar la fecha máxima para el nombre del archivo
-    if compras_fechas:
-        operation_date = max(compras_fechas)
-        operation_date_str = operation_date.strftime("%d%b%Y")
-    else:
-        # Si no hay fechas de compras, usar la fecha actual
-        operation_date_str = datetime.now().strftime("%d%b%Y")
-    
-    # Generar nombre de archivo dinámico
-    output_file = f"{base_output}_{operation_date_str}.xlsx"
-    excel_output_path = os.path.join(OUTPUT_DIR, output_file)
+    return df_msi, df_compras[COMPRAS_COLUMNS]
+
+def fecha_operacion_maxima(df_compras):
+    """Fecha de operación máxima de las compras (formato del nombre de archivo)."""
+    operation_date = df_compras["Fecha de la operación"].max()
+    if pd.notna(operation_date):
+        return operation_date.strftime("%d%b%Y")
+    # Si no hay fechas de compras, usar la fecha actual
+    return datetime.now().strftime("%d%b%Y")
+
+# === Cache de extracción ===
+def _cache_path(digest, mode):
+    return os.path.join(CACHE_DIR, f"{digest}_{mode}_v{PARSER_VERSION}.pkl.gz")
+
+def cargar_cache(digest, mode=EXTRACTION_MODE):
+    """Regresa (df_msi, df_compras) del cache o None si no existe o está dañado."""
+    path = _cache_path(digest, mode)
+    if not os.path.exists(path):
+        return None
+    try:
+        frames = pd.read_pickle(path, compression="gzip")
+        return frames["msi"], frames["compras"]
+    except Exception as e:
+        print(f"⚠️ Cache inválido {os.path.basename(path)}: {e}")
+        return None
+
+def guardar_cache(digest, df_msi, df_compras, mode=EXTRACTION_MODE):
+    """Guarda las tablas extraídas (pickle columnar comprimido, escritura atómica)."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = _cache_path(digest, mode)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    pd.to_pickle({"msi": df_msi, "compras": df_compras}, tmp_path, compression="gzip")
+    os.replace(tmp_path, path)
+
+def resolver_pdf(pdf_file):
+    """
+    Ruta del PDF: una ruta existente (relativa al directorio actual o absoluta)
+    o con directorio se usa tal cual; un nombre solo se busca en DATA_IMPORT_DIR.
+    """
+    if os.path.exists(pdf_file) or os.path.dirname(pdf_file):
+        return pdf_file
+    return os.path.join(DATA_IMPORT_DIR, pdf_file)
+
+def extraer_datos_bbva(pdf_file=pdf_file, use_cache=True, mode=EXTRACTION_MODE, digest=None):
+    """
+    Extrae las secciones MSI y compras regulares de un estado de cuenta BBVA.
+    Con use_cache, un PDF ya procesado (mismo contenido, modo y PARSER_VERSION) se
+    sirve desde CACHE_DIR sin abrir PyMuPDF; digest es el hash_file del PDF si
+    quien llama ya lo calculó.
+    Regresa (df_msi, df_compras, operation_date_str).
+    """
+    pdf_path = resolver_pdf(pdf_file)
     
-    # Crear DataFrames
-    df_msi = pd.DataFrame(msi_data, columns=["Fecha operación", "Descripción", "Monto original", 
-                                            "Saldo pendiente", "Pago requerido", "Núm. de pago", 
-                                            "Tasa de interés aplicable"])
+    # Verificar que el archivo PDF existe
+    if not os.path.exists(pdf_path):
+        raise FileNotFoundError(f"No se encontró el archivo PDF: {pdf_path}")
     
-    df_compras = pd.DataFrame(compras_data, columns=["Fecha de la operación", "Fecha de cargo", 
-                                                    "Pago requerido", "Descripción"])
+    frames = None
+    if use_cache:
+        digest = digest or hash_file(pdf_path)
+        frames = cargar_cache(digest, mode)
+    if frames is None:
+        frames = _extraer_secciones(pdf_path, mode)
+        if use_cache:
+            guardar_cache(digest, *frames, mode=mode)
     
-    # Guardar en Excel
-    with pd.ExcelWriter(excel_output_path, engine='openpyxl') as writer:
-        df_msi.to_excel(writer, sheet_name='msi', index=False)
-        df_compras.to_excel(writer, sheet_name='compras', index=False)
+    df_msi, df_compras = frames
+    return df_msi, df_compras, fecha_operacion_maxima(df_compras)
+
+# === Escritura de salidas ===
+def rutas_salida(operation_date_str, pdf_name, fmt=OUTPUT_FORMAT):
+    """
+    Rutas de salida por tabla: en xlsx ambas tablas van en un solo libro
+    (hojas msi/compras); en parquet y csv va un archivo por tabla.
+    El nombre lleva el del PDF además de la fecha: dos estados con la misma
+    fecha máxima (o sin compras, que usan la fecha actual) no se sobrescriben.
+    """
+    pdf_stem = os.path.splitext(os.path.basename(pdf_name))[0]
+    base = os.path.join(OUTPUT_DIR, f"{base_output}_{operation_date_str}_{pdf_stem}")
+    if fmt == "xlsx":
+        return {"msi": f"{base}.xlsx", "compras": f"{base}.xlsx"}
+    return {table: f"{base}_{table}.{fmt}" for table in ("msi", "compras")}
+
+def _write_sheet(workbook, name, df, date_format):
+    """Escribe un DataFrame fila por fila (requisito del modo constant_memory)."""
+    ws = workbook.add_worksheet(name)
+    ws.write_row(0, 0, list(df.columns))
+    columns = []
+    for column in df.columns:
+        series = df[column]
+        values = series.astype(object).where(series.notna(), None).tolist()
+        is_date = pd.api.types.is_datetime64_any_dtype(series)
+        if is_date:
+            ws.set_column(len(columns), len(columns), 12)
+        columns.append((values, is_date))
+    for row_idx in range(len(df)):
+        for col_idx, (values, is_date) in enumerate(columns):
+            value = values[row_idx]
+            if value is None:
+                continue
+            if is_date:
+                ws.write_datetime(row_idx + 1, col_idx, value, date_format)
+            else:
+                ws.write(row_idx + 1, col_idx, value)
+
+def guardar_excel(df_msi, df_compras, operation_date_str, pdf_name):
+    """Guarda las hojas msi/compras en un xlsx con xlsxwriter en modo constant_memory."""
+    path = rutas_salida(operation_date_str, pdf_name, "xlsx")["msi"]
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+    try:
+        date_format = workbook.add_format({"num_format": "yyyy-mm-dd"})
+        _write_sheet(workbook, "msi", df_msi, date_format)
+        _write_sheet(workbook, "compras", df_compras, date_format)
+    finally:
+        workbook.close()
+    return [path]
+
+def guardar_parquet(df_msi, df_compras, operation_date_str, pdf_name):
+    """Guarda cada tabla en su propio archivo Parquet (requiere pyarrow)."""
+    paths = rutas_salida(operation_date_str, pdf_name, "parquet")
+    df_msi.to_parquet(paths["msi"], index=False)
+    df_compras.to_parquet(paths["compras"], index=False)
+    return list(paths.values())
+
+def guardar_csv(df_msi, df_compras, operation_date_str, pdf_name):
+    """Guarda cada tabla en su propio archivo CSV (fechas ISO)."""
+    paths = rutas_salida(operation_date_str, pdf_name, "csv")
+    df_msi.to_csv(paths["msi"], index=False, date_format="%Y-%m-%d")
+    df_compras.to_csv(paths["compras"], index=False, date_format="%Y-%m-%d")
+    return list(paths.values())
+
+OUTPUT_WRITERS = {
+    "xlsx": guardar_excel,
+    "parquet": guardar_parquet,
+    "csv": guardar_csv,
+}
+
+def guardar_salida(df_msi, df_compras, operation_date_str, pdf_name, fmt=OUTPUT_FORMAT):
+    """Guarda las tablas msi/compras en el formato indicado; regresa las rutas escritas."""
+    if fmt not in OUTPUT_WRITERS:
+        raise ValueError(f"Formato de salida no soportado: {fmt}")
+    return OUTPUT_WRITERS[fmt](df_msi, df_compras, operation_date_str, pdf_name)
+
+def leer_salida(operation_date_str, pdf_name, fmt=OUTPUT_FORMAT):
+    """Lee las tablas (df_msi, df_compras) escritas por guardar_salida."""
+    paths = rutas_salida(operation_date_str, pdf_name, fmt)
+    if fmt == "xlsx":
+        sheets = pd.read_excel(paths["msi"], sheet_name=["msi", "compras"])
+        return sheets["msi"], sheets["compras"]
+    if fmt == "parquet":
+        return pd.read_parquet(paths["msi"]), pd.read_parquet(paths["compras"])
+    if fmt == "csv":
+        return (
+            pd.read_csv(paths["msi"], parse_dates=["Fecha operación"]),
+            pd.read_csv(paths["compras"], parse_dates=["Fecha de la operación", "Fecha de cargo"]),
+        )
+    raise ValueError(f"Formato de salida no soportado: {fmt}")
+
+# === Seguimiento de planes MSI ===
+def normalizar_planes_msi(df_msi):
+    """
+    Convierte la hoja msi a planes: llave (fecha, descripción, monto original,
+    seq) y estado (pago actual/total, saldo, pago requerido, tasa).
+    """
+    num_pago = df_msi["Núm. de pago"].astype("string").str.extract(r"(\d+)\s*de\s*(\d+)")
+    df = pd.DataFrame({
+        "operation_date": pd.to_datetime(df_msi["Fecha operación"]),
+        "description": df_msi["Descripción"].astype("string").str.strip(),
+        "original_amount": df_msi["Monto original"].astype("float64").round(2),
+        "payment_number": pd.to_numeric(num_pago[0], errors="coerce").astype("Int64"),
+        "total_payments": pd.to_numeric(num_pago[1], errors="coerce").astype("Int64"),
+        "pending_balance": df_msi["Saldo pendiente"].astype("float64").round(2),
+        "required_payment": df_msi["Pago requerido"].astype("float64").round(2),
+        "interest_rate": df_msi["Tasa de interés aplicable"].astype("string"),
+    }).dropna(subset=["operation_date", "description", "original_amount"])
+    # Planes idénticos dentro del mismo estado se distinguen por su orden de aparición
+    df["seq"] = df.groupby(["operation_date", "description", "original_amount"]).cumcount()
+    return df
+
+def diff_planes_msi(df_plans, df_state, statement_date, latest_date=None):
+    """
+    Compara los planes de un estado contra el estado guardado (solo pandas).
+    Regresa (nuevos, cambiados, cerrados):
+    - nuevos: llaves que no existen; si ya hay un estado más reciente que este,
+      entran cerrados (ese estado más reciente ya no los incluía).
+    - cambiados: planes cuyo pago/saldo difiere, solo si este estado es más
+      reciente que el último aplicado al plan (no se retrocede con estados viejos).
+      Solo el estado más reciente deja el plan abierto.
+    - cerrados: planes abiertos ausentes de un estado más reciente.
+    """
+    key = ["operation_date", "description", "original_amount", "seq"]
+    state = df_state.copy()
+    state["operation_date"] = pd.to_datetime(state["operation_date"])
+    state["original_amount"] = state["original_amount"].astype("float64").round(2)
+    state["seq"] = state["seq"].astype("int64")
+    state["last_statement_date"] = pd.to_datetime(state["last_statement_date"])
+    statement_date = pd.Timestamp(statement_date)
+
+    merged = df_plans.merge(state, on=key, how="outer", suffixes=("", "_prev"), indicator=True)
+    newer = merged["last_statement_date"] < statement_date
+
+    df_new = merged[merged["_merge"] == "left_only"].copy()
+    is_latest = latest_date is None or statement_date >= pd.Timestamp(latest_date)
+    df_new["status"] = "open" if is_latest else "closed"
+
+    both = merged[(merged["_merge"] == "both") & newer]
+    changed = (
+        both["status"].ne("open")
+        | both["payment_number"].astype("float64").ne(both["payment_number_prev"].astype("float64"))
+        | both["pending_balance"].ne(both["pending_balance_prev"].astype("float64").round(2))
+        | both["required_payment"].ne(both["required_payment_prev"].astype("float64").round(2))
+    )
+    df_changed = both[changed].copy()
+    # Un estado intermedio actualiza el avance pero no reabre un plan ya cerrado
+    df_changed["status"] = "open" if is_latest else df_changed["status"]
+
+    closed = (merged["_merge"] == "right_only") & (merged["status"] == "open") & newer
+    # Un estado sin filas MSI (p. ej. extracción fallida) no cierra planes
+    df_closed = merged[closed] if len(df_plans) else merged.iloc[0:0]
+
+    columns = df_plans.columns.tolist()
+    return (
+        df_new[columns + ["status"]],
+        df_changed[["id_plan"] + columns + ["status"]],
+        df_closed[["id_plan"]],
+    )
+
+def registrar_planes_msi(cur, df_msi, statement_date):
+    """Aplica en la base solo los planes MSI nuevos y los cambios de estado."""
+    from database_utils import load_msi_plans, apply_msi_plan_changes
     
-    print(f"Datos extraídos y guardados en {excel_output_path}")
-    print(f"- {len(msi_data)} registros en hoja 'msi'")
-    print(f"- {len(compras_data)} registros en hoja 'compras'")
-    print(f"- Fecha de operación máxima: {operation_date_str}")
+    df_plans = normalizar_planes_msi(df_msi)
+    df_state = load_msi_plans(cur, df_plans)
+    cur.execute("SELECT max(operation_date) FROM card_statement WHERE msi_rows > 0;")
+    latest_date = cur.fetchone()[0]
+    df_new, df_changed, df_closed = diff_planes_msi(df_plans, df_state, statement_date, latest_date)
+    return apply_msi_plan_changes(cur, df_new, df_changed, df_closed, pd.Timestamp(statement_date))
+
+# === Carga directa a Postgres ===
+def cargar_estado_db(pdf_path, df_msi, df_compras, digest=None):
+    """
+    Carga las tablas extraídas directo a Postgres (COPY) con una conexión del
+    pool de database_utils. Es idempotente por contenido del PDF (digest).
+    """
+    from database_utils import get_connection, load_statement
     
-    return len(msi_data), len(compras_data), operation_date_str
+    operation_date = df_compras["Fecha de la operación"].max()
+    # Con fecha de estado los MSI se guardan como planes (solo cambios), no como copia completa
+    track_plans = pd.notna(operation_date)
+    # Conexión del pool de database_utils (se reutiliza entre PDFs del mismo proceso)
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            id_statement = load_statement(
+                cur, digest or hash_file(pdf_path), os.path.basename(pdf_path),
+                operation_date.date() if track_plans else None,
+                df_msi, df_compras, msiSnapshot=not track_plans
+            )
+            if track_plans:
+                registrar_planes_msi(cur, df_msi, operation_date)
+        conn.commit()
+    return id_statement
+
+def convertir_estado_cuenta(pdf_path, use_cache=True, mode=EXTRACTION_MODE, fmt=OUTPUT_FORMAT, load_db=False):
+    """
+    Convierte un estado de cuenta (extracción + salida en fmt, si se indica, y
+    carga a Postgres con load_db) y regresa un resumen con conteos y tiempos.
+    Es la unidad de trabajo del modo por lotes.
+    """
+    start = time.perf_counter()
+    pdf_path = resolver_pdf(pdf_path)
+    # Un solo hash por PDF: llave del cache y del estado de cuenta en Postgres
+    digest = hash_file(pdf_path) if use_cache or load_db else None
+    df_msi, df_compras, operation_date_str = extraer_datos_bbva(pdf_path, use_cache, mode, digest)
+    extracted = time.perf_counter()
+    output_paths = guardar_salida(df_msi, df_compras, operation_date_str, pdf_path, fmt) if fmt else []
+    id_statement = cargar_estado_db(pdf_path, df_msi, df_compras, digest) if load_db else None
+    return {
+        "pdf": os.path.basename(pdf_path),
+        "outputs": output_paths,
+        "id_statement": id_statement,
+        "msi": len(df_msi),
+        "compras": len(df_compras),
+        "operation_date": operation_date_str,
+        "extract_seconds": extracted - start,
+        "total_seconds": time.perf_counter() - start,
+    }
+
+def listar_estados_cuenta(pdfDir=DATA_IMPORT_DIR):
+    """Lista (ordenados) los PDF del directorio de estados de cuenta."""
+    return [
+        os.path.join(pdfDir, file_name)
+        for file_name in sorted(os.listdir(pdfDir))
+        if file_name.lower().endswith(".pdf")
+    ]
+
+def convertir_lote(pdfPaths, workers=CONVERSION_WORKERS, use_cache=True, mode=EXTRACTION_MODE,
+                   fmt=OUTPUT_FORMAT, load_db=False):
+    """
+    Convierte varios estados de cuenta; con workers > 1 usa un pool de procesos
+    (la extracción es CPU-bound). Regresa (resúmenes, errores).
+    """
+    results, errors = [], []
+    if workers > 1 and len(pdfPaths) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(pdfPaths))) as executor:
+            futures = {executor.submit(convertir_estado_cuenta, path, use_cache, mode, fmt, load_db): path for path in pdfPaths}
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    errors.append((os.path.basename(futures[future]), str(e)))
+    else:
+        for path in pdfPaths:
+            try:
+                results.append(convertir_estado_cuenta(path, use_cache, mode, fmt, load_db))
+            except Exception as e:
+                errors.append((os.path.basename(path), str(e)))
+    return results, errors
 
 # Uso del script
 if __name__ == "__main__":
-    try:
-        print("Iniciando extracción de datos BBVA...")
-        msi_count, compras_count, operation_date = extraer_datos_bbva()
-        print(f"Proceso completado. Extraídos: {msi_count} MSI, {compras_count} compras regulares")
-        print(f"Archivo generado: cargos_bbva_{operation_date}.xlsx")
-    except Exception as e:
-        print(f"❌ Error durante la extracción: {e}")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Extracción de cargos de estados de cuenta BBVA (PDF -> XLSX)")
+    parser.add_argument("pdfs", nargs="*",
+                        help=f"PDF a convertir (por defecto todos los de {DATA_IMPORT_DIR})")
+    parser.add_argument("--workers", type=int, default=CONVERSION_WORKERS,
+                        help="Número de estados de cuenta procesados en paralelo")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Ignorar el cache de extracción y volver a leer los PDF")
+    parser.add_argument("--mode", choices=["text", "layout"], default=EXTRACTION_MODE,
+                        help="Extracción por regex sobre el texto o por coordenadas de palabras")
+    parser.add_argument("--format", choices=list(OUTPUT_WRITERS) + ["none"], default=None,
+                        help=f"Formato de salida de las tablas msi/compras (por defecto {OUTPUT_FORMAT}, "
+                             "o ninguno con --load-db)")
+    parser.add_argument("--load-db", action="store_true",
+                        help="Cargar las filas extraídas directo a Postgres (DB_CONFIG de database_utils)")
+    args = parser.parse_args()
+    output_format = args.format or ("none" if args.load_db else OUTPUT_FORMAT)
+    output_format = None if output_format == "none" else output_format
+    if output_format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        parser.error("--format parquet requiere pyarrow (pip install pyarrow)")
+
+    pdf_paths = [resolver_pdf(p) for p in args.pdfs] or listar_estados_cuenta()
+    print(f"Iniciando extracción de datos BBVA ({len(pdf_paths)} archivos, {args.workers} workers)...")
+    start = time.perf_counter()
+    results, errors = convertir_lote(
+        pdf_paths, args.workers, not args.no_cache, args.mode, output_format, args.load_db
+    )
+
+    for result in sorted(results, key=lambda r: r["pdf"]):
+        destinations = [os.path.basename(p) for p in result["outputs"]]
+        if result["id_statement"] is not None:
+            destinations.append(f"Postgres (id_statement {result['id_statement']})")
+        print(f"- {result['pdf']}: {result['msi']} MSI, {result['compras']} compras, "
+              f"fecha {result['operation_date']}, extracción {result['extract_seconds']:.2f}s, "
+              f"total {result['total_seconds']:.2f}s -> {', '.join(destinations)}")
+    for pdf_name, error in errors:
+        print(f"❌ Error durante la extracción de {pdf_name}: {error}")
+    print(f"Proceso completado: {len(results)} convertidos, {len(errors)} con errores "
+          f"en {time.perf_counter() - start:.2f}s")
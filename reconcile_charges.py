@@ -0,0 +1,184 @@
+import argparse
+import os
+import time
+import pandas as pd
+from datetime import datetime
+# Importar funciones generales
+from utils_tools import print_log
+from database_utils import get_connection
+
+# Rutas base del proyecto
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+OUTPUT_DIR = os.path.join(BASE_DIR, "reconcile_files")
+
+# === Configuración ===
+# Forma de pago de las compras que se concilian contra el estado de cuenta
+PAYMENT_TYPE = "Tarjeta de Crédito"
+# Tolerancias: días entre compra y operación del cargo, y pesos de diferencia en el monto
+DATE_TOLERANCE_DAYS = 5
+AMOUNT_TOLERANCE = 1.00
+
+CHARGE_COLUMNS = ["id_charge", "operation_date", "amount", "description"]
+PURCHASE_COLUMNS = ["id_purchase", "purchase_date", "total"]
+
+# ======= CARGA DE DATOS =======
+def load_charges(cursor, fromDate=None, toDate=None):
+    """
+    Cargos (compras regulares con monto positivo) de los estados cargados con
+    pdf_to_xlsx --load-db. Un mismo estado cargado con dos nombres se cuenta
+    una sola vez.
+    """
+    cursor.execute(
+        """
+            SELECT DISTINCT ON (c.operation_date, c.charge_date, c.amount, c.description, c.row_num)
+                s.id_statement || '-' || c.row_num AS id_charge,
+                c.operation_date, c.amount, c.description
+            FROM card_charge c
+            JOIN card_statement s ON s.id_statement = c.id_statement
+            WHERE c.amount > 0
+              AND (%s::date IS NULL OR c.operation_date >= %s::date)
+              AND (%s::date IS NULL OR c.operation_date <= %s::date)
+            ORDER BY c.operation_date, c.charge_date, c.amount, c.description, c.row_num, s.id_statement;
+        """,
+        (fromDate, fromDate, toDate, toDate)
+    )
+    return pd.DataFrame(cursor.fetchall(), columns=CHARGE_COLUMNS)
+
+def charges_from_statement(dfCompras, pdfName=""):
+    """Cargos a partir de la hoja compras de extraer_datos_bbva (sin pasar por la base)."""
+    df = dfCompras[dfCompras["Pago requerido"] > 0]
+    return pd.DataFrame({
+        "id_charge": [f"{pdfName}-{i}" for i in df.index],
+        "operation_date": df["Fecha de la operación"].to_numpy(),
+        "amount": df["Pago requerido"].to_numpy(),
+        "description": df["Descripción"].to_numpy(),
+    })
+
+def load_purchases(cursor, fromDate=None, toDate=None):
+    """Compras registradas por data_ingestion y pagadas con PAYMENT_TYPE."""
+    cursor.execute(
+        """
+            SELECT p.id_purchase, p.purchase_date, p.total
+            FROM purchase p
+            JOIN payment_type pt ON pt.id_payment_type = p.id_payment_type
+            WHERE pt.payment_type = %s
+              AND p.total IS NOT NULL
+              AND (%s::date IS NULL OR p.purchase_date >= %s::date)
+              AND (%s::date IS NULL OR p.purchase_date <= %s::date)
+            ORDER BY p.purchase_date, p.id_purchase;
+        """,
+        (PAYMENT_TYPE, fromDate, fromDate, toDate, toDate)
+    )
+    return pd.DataFrame(cursor.fetchall(), columns=PURCHASE_COLUMNS)
+
+# ======= CONCILIACIÓN =======
+def _prepare(df, dateColumn, amountColumn):
+    """Tipos fijos (datetime64/float64), sin nulos y ordenado por fecha."""
+    df = df.copy()
+    df[dateColumn] = pd.to_datetime(df[dateColumn]).astype("datetime64[ns]")
+    df[amountColumn] = pd.to_numeric(df[amountColumn], errors="coerce").astype("float64")
+    df = df.dropna(subset=[dateColumn, amountColumn]).sort_values(dateColumn, kind="stable")
+    return df
+
+def reconcile(dfCharges, dfPurchases, dateTolerance=DATE_TOLERANCE_DAYS, amountTolerance=AMOUNT_TOLERANCE):
+    """
+    Concilia cargos contra compras por fecha y monto con tolerancia.
+
+    Cada fila cae en una cubeta (monto // amountTolerance, día // dateTolerance;
+    con tolerancia 0 la cubeta es de un centavo / un día y solo pasan iguales)
+    y las compras se replican en las cubetas vecinas, así que un equi-join por
+    cubeta trae todo candidato con |Δmonto| <= amountTolerance y
+    |Δdías| <= dateTolerance sin comparar contra todo el historial; después se
+    filtran las tolerancias exactas. Cada cargo se clasifica:
+    - matched: un solo candidato y ese candidato no tiene otro cargo.
+    - ambiguous: cargos y compras que comparten candidatos (se entregan todos
+      los pares con sus diferencias para revisión).
+    - unmatched: cargos y compras sin ningún candidato.
+    Regresa un dict con matched, ambiguous, unmatched_charges y unmatched_purchases.
+    """
+    charges = _prepare(dfCharges, "operation_date", "amount")
+    purchases = _prepare(dfPurchases, "purchase_date", "total")
+    day_width = max(int(dateTolerance), 1)
+    amount_width = max(amountTolerance, 0.01)
+    bucket = ["amount_bucket", "date_bucket"]
+    charges["amount_bucket"] = (charges["amount"] // amount_width).astype("int64")
+    charges["date_bucket"] = charges["operation_date"].values.astype("datetime64[D]").astype("int64") // day_width
+    amount_bucket = (purchases["total"] // amount_width).astype("int64")
+    date_bucket = purchases["purchase_date"].values.astype("datetime64[D]").astype("int64") // day_width
+    expanded = pd.concat(
+        [
+            purchases.assign(amount_bucket=amount_bucket + da, date_bucket=date_bucket + dd)
+            for da in (-1, 0, 1) for dd in (-1, 0, 1)
+        ],
+        ignore_index=True
+    )
+
+    pairs = charges.merge(expanded, on=bucket, how="inner")
+    pairs["amount_diff"] = (pairs["amount"] - pairs["total"]).round(2)
+    pairs["days_diff"] = (pairs["operation_date"] - pairs["purchase_date"]).dt.days
+    pairs = pairs[
+        (pairs["amount_diff"].abs() <= amountTolerance)
+        & (pairs["days_diff"].abs() <= dateTolerance)
+    ].drop(columns=bucket)
+
+    charge_hits = pairs.groupby("id_charge")["id_purchase"].transform("size")
+    purchase_hits = pairs.groupby("id_purchase")["id_charge"].transform("size")
+    unique = (charge_hits == 1) & (purchase_hits == 1)
+    matched = pairs[unique].sort_values("operation_date", kind="stable")
+    ambiguous = pairs[~unique].sort_values(["id_charge", "purchase_date"], kind="stable")
+
+    return {
+        "matched": matched.reset_index(drop=True),
+        "ambiguous": ambiguous.reset_index(drop=True),
+        "unmatched_charges": charges[~charges["id_charge"].isin(pairs["id_charge"])]
+            .drop(columns=bucket).reset_index(drop=True),
+        "unmatched_purchases": purchases[~purchases["id_purchase"].isin(pairs["id_purchase"])]
+            .reset_index(drop=True),
+    }
+
+def save_results(results, outputDir=OUTPUT_DIR):
+    """Guarda cada conjunto en CSV (conciliacion_<conjunto>_<fecha>.csv)."""
+    os.makedirs(outputDir, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    paths = []
+    for name, df in results.items():
+        path = os.path.join(outputDir, f"conciliacion_{name}_{stamp}.csv")
+        df.to_csv(path, index=False, date_format="%Y-%m-%d")
+        paths.append(path)
+    return paths
+
+# Uso del script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Conciliación de cargos de tarjeta contra compras registradas")
+    parser.add_argument("--from", dest="from_date", help="Fecha inicial (AAAA-MM-DD)")
+    parser.add_argument("--to", dest="to_date", help="Fecha final (AAAA-MM-DD)")
+    parser.add_argument("--days", type=int, default=DATE_TOLERANCE_DAYS,
+                        help="Tolerancia en días entre compra y cargo")
+    parser.add_argument("--tolerance", type=float, default=AMOUNT_TOLERANCE,
+                        help="Tolerancia en pesos entre monto de compra y cargo")
+    parser.add_argument("--pdf", nargs="*", default=[],
+                        help="Tomar los cargos de estados de cuenta PDF en lugar de la base")
+    args = parser.parse_args()
+    if args.days < 0 or args.tolerance < 0:
+        parser.error("--days y --tolerance no pueden ser negativos")
+
+    start = time.perf_counter()
+    # Conexión del pool de database_utils
+    with get_connection() as conn:
+        cur = conn.cursor()
+        if args.pdf:
+            from pdf_to_xlsx import extraer_datos_bbva
+            df_charges = pd.concat(
+                [charges_from_statement(extraer_datos_bbva(pdf)[1], os.path.basename(pdf)) for pdf in args.pdf],
+                ignore_index=True
+            )
+        else:
+            df_charges = load_charges(cur, args.from_date, args.to_date)
+        df_purchases = load_purchases(cur, args.from_date, args.to_date)
+    print_log(f"Cargos: {len(df_charges)}, compras: {len(df_purchases)}")
+
+    results = reconcile(df_charges, df_purchases, args.days, args.tolerance)
+    paths = save_results(results)
+    for name, df in results.items():
+        print(f"- {name}: {len(df)}")
+    print(f"Conciliación completada en {time.perf_counter() - start:.2f}s -> {os.path.dirname(paths[0])}")
@@ -1,11 +1,15 @@
+import json
 import numpy as np
 import os
 import pandas as pd
 import re
 import requests
+import threading
 import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from requests.adapters import HTTPAdapter
 from psycopg2.extensions import register_adapter, AsIs
 from urllib.parse import urlparse
 
@@ -22,6 +26,21 @@ ENABLE_LOGS = True
 PROCESSED_DIR = "data_processed"
 ERRORS_DIR = "data_errors"
 
+# ==== VERIFICACIÓN DE URLs ====
+URL_CACHE_FILE = os.path.join(current_dir, "url_verify_cache.json")
+URL_CACHE_TTL = 7 * 24 * 60 * 60  # segundos (7 días)
+URL_TIMEOUT = 10  # segundos
+URL_VERIFY_WORKERS = 16  # peticiones simultáneas en total
+URL_MAX_PER_HOST = 4  # peticiones simultáneas por host
+# Define un User-Agent que simula un navegador web.
+URL_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+}
+# Sesión (pool de conexiones) y semáforo por host
+_url_sessions = {}
+_url_host_limits = {}
+_url_lock = threading.Lock()
+
 # Registrar adaptadores para tipos NumPy
 def adapt_numpy_float64(numpyFloat):
     return AsIs(float(numpyFloat))
@@ -38,74 +57,194 @@ def print_log(message):
     if ENABLE_LOGS:
         print(message)
 
-def ultra_convert(value):
-    """Versión mejorada con manejo de NumPy"""
-    if value is None or pd.isna(value):
-        return None
-    if hasattr(value, 'item'):  # numpy.generic
-        return value.item()
-    if isinstance(value, (np.floating, np.integer)):
-        return float(value) if isinstance(value, np.floating) else int(value)
-    if isinstance(value, (float, int)):
-        return float(value) if isinstance(value, float) else int(value)
-    if isinstance(value, pd.Timestamp):
-        return value.to_pydatetime()
-    return str(value) if not isinstance(value, (str, bytes)) else value
+def _get_host_session(host):
+    """Devuelve la sesión HTTP del host (reutiliza conexiones keep-alive)."""
+    with _url_lock:
+        if host not in _url_sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=URL_MAX_PER_HOST)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update(URL_HEADERS)
+            _url_sessions[host] = session
+            _url_host_limits[host] = threading.BoundedSemaphore(URL_MAX_PER_HOST)
+        return _url_sessions[host], _url_host_limits[host]
 
-def safe_convert_to_float(value):
+def load_url_cache(cachePath=URL_CACHE_FILE):
+    """Lee el caché de verificación {url: {"is_active", "checked_at"}}."""
+    try:
+        with open(cachePath, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_url_cache(cache, cachePath=URL_CACHE_FILE):
+    """Guarda el caché mezclándolo con lo que otro proceso haya escrito."""
+    merged = load_url_cache(cachePath)
+    merged.update(cache)
+    tmp_path = f"{cachePath}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(merged, f)
+    os.replace(tmp_path, cachePath)
+
+def _head_url(url, timeout=URL_TIMEOUT):
+    host = urlparse(url).netloc.lower()
+    session, host_limit = _get_host_session(host)
+    with host_limit:
+        try:
+            response = session.head(url, allow_redirects=True, timeout=timeout)
+            status_code = response.status_code
+            print_log(f"status_code: {status_code}, url: {url}")
+            return status_code == 200
+        except requests.RequestException as e:
+            print_log(f"RequestException: {e}")
+            return False
+
+def verify_urls(urls, cachePath=URL_CACHE_FILE, ttl=URL_CACHE_TTL, timeout=URL_TIMEOUT, maxWorkers=URL_VERIFY_WORKERS):
     """
-    Conversión segura a float que maneja 'None', NaN, y otros casos especiales
+    Verifica varias URLs con peticiones HEAD concurrentes.
+    Usa el caché en disco (con TTL) y devuelve {url: bool}.
     """
-    if pd.isna(value) or value is None or str(value).strip().lower() in ['none', 'nan', '']:
-        return None
-    try:
-        return float(str(value).replace(',', '.'))  # Maneja formatos con coma decimal
-    except (ValueError, TypeError):
-        return None
+    now = time.time()
+    cache = load_url_cache(cachePath) if cachePath else {}
+    results = {}
+    pending = []
+    for url in dict.fromkeys(urls):
+        entry = cache.get(url) if url else None
+        if not url:
+            results[url] = False
+        elif entry and now - entry["checked_at"] < ttl:
+            results[url] = entry["is_active"]
+        else:
+            pending.append(url)
+    print_log(f"verify_urls: {len(results)} en caché, {len(pending)} por verificar")
+    if not pending:
+        return results
+    with ThreadPoolExecutor(max_workers=min(maxWorkers, len(pending))) as executor:
+        checked = executor.map(lambda url: _head_url(url, timeout), pending)
+        for url, is_active in zip(pending, checked):
+            results[url] = is_active
+            cache[url] = {"is_active": is_active, "checked_at": now}
+    if cachePath:
+        save_url_cache({url: cache[url] for url in pending}, cachePath)
+    return results
+
+def verify_url(url):
+    """Verifica una sola URL (ver verify_urls)."""
+    return verify_urls([url])[url]
 
-def ensure_default(value):
-    ntv_value = ensure_native(value)
-    if ntv_value:
-        return ntv_value
+def normalize_description(series):
+    """
+    Llave normalizada de una columna de texto (vectorizado): sin acentos,
+    en minúsculas (casefold) y con espacios colapsados. Vacíos -> <NA>.
+    """
+    key = (
+        series.astype("string")
+        .str.normalize("NFKD")
+        .str.replace(r"[\u0300-\u036f]", "", regex=True)
+        .str.casefold()
+        .str.replace(r"\s+", " ", regex=True)
+        .str.strip()
+    )
+    return key.mask(key == "")
+
+# ==== CODIFICACIÓN DE PARÁMETROS ====
+
+def _infer_column_type(series):
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return "datetime"
+    if pd.api.types.is_bool_dtype(series):
+        return "bool"
+    if pd.api.types.is_integer_dtype(series):
+        return "int"
+    if pd.api.types.is_float_dtype(series):
+        return "float"
+    return "object"
+
+def _encode_series(series, colType=None, default=None, maxLength=None):
+    """Convierte una columna completa a una lista de valores nativos de Python."""
+    colType = colType or _infer_column_type(series)
+    if colType == "datetime":
+        values = pd.to_datetime(series, errors="coerce")
+        mask = values.isna().to_numpy()
+        converted = np.asarray(values.dt.to_pydatetime(), dtype=object)[~mask].tolist()
+    elif colType in ("int", "float"):
+        values = pd.to_numeric(series, errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+        mask = np.isnan(values)
+        valid = values[~mask]
+        converted = np.trunc(valid).astype(np.int64).tolist() if colType == "int" else valid.tolist()
+    elif colType == "bool":
+        mask = series.isna().to_numpy()
+        converted = series[~mask].astype(bool).tolist()
     else:
-        return 0
+        mask = series.isna().to_numpy()
+        valid = series[~mask]
+        if colType == "text":
+            valid = valid.astype(str)
+            if maxLength is not None:
+                valid = valid.str.slice(0, maxLength)
+        converted = valid.tolist()
+    out = np.empty(len(series), dtype=object)
+    out[:] = default
+    out[~mask] = converted
+    return out.tolist()
 
-def ensure_native(value):
-    """Convierte cualquier valor a tipos nativos de Python"""
-    if value is None or (hasattr(value, '__array__') and np.isnan(value).any()):
-        return None
-    if hasattr(value, 'item'):  # Para numpy.generic
-        return value.item()
-    if isinstance(value, (np.floating, np.float32, np.float64)):
-        return float(value)
-    if isinstance(value, (np.integer, np.int32, np.int64)):
-        return int(value)
-    if isinstance(value, (float, int, str)):
-        return value
+def encode_value(value, colType=None, default=None, maxLength=None):
+    """Versión escalar de _encode_series: codifica un valor sin armar un DataFrame."""
+    if value is None or (np.ndim(value) == 0 and pd.isna(value)):
+        return default
+    if colType == "datetime":
+        value = pd.to_datetime(value, errors="coerce")
+        return default if pd.isna(value) else value.to_pydatetime()
+    if colType in ("int", "float"):
+        value = pd.to_numeric(value, errors="coerce")
+        if pd.isna(value):
+            return default
+        return int(np.trunc(value)) if colType == "int" else float(value)
+    if colType == "bool":
+        return bool(value)
+    if colType == "text":
+        value = str(value)
+        return value[:maxLength] if maxLength is not None else value
     if isinstance(value, pd.Timestamp):
         return value.to_pydatetime()
-    try:
-        return float(value)
-    except (ValueError, TypeError):
-        return str(value)
+    return value.item() if isinstance(value, np.generic) else value
 
-def verify_url(url):
-    # Define un User-Agent que simula un navegador web.
-    # Puedes usar cualquier cadena de User-Agent de un navegador popular.
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-    }
-    try:
-        response = requests.head(url, allow_redirects=True, timeout=10, headers=headers)
-        status_code = response.status_code
-        print_log(f"status_code: {status_code}, response: {response}")
-        if status_code == 200:
-            return True
+def encode_row(record, columnTypes, defaults=None, maxLengths=None):
+    """Tupla de parámetros de un dict (en el orden de columnTypes), ver encode_rows."""
+    defaults = defaults or {}
+    maxLengths = maxLengths or {}
+    return tuple(
+        encode_value(record.get(col), col_type, defaults.get(col), maxLengths.get(col))
+        for col, col_type in columnTypes.items()
+    )
+
+def encode_columns(df, columnTypes=None, defaults=None, maxLengths=None):
+    """
+    Codifica un DataFrame columna por columna a valores nativos (sin NumPy ni NaN).
+    columnTypes: {columna: "int" | "float" | "text" | "datetime" | "bool" | None (inferido)}
+    defaults: valor para los nulos por columna (None si no se indica)
+    Columnas que no existen en el DataFrame se llenan con su default.
+    """
+    columnTypes = columnTypes if columnTypes is not None else dict.fromkeys(df.columns)
+    defaults = defaults or {}
+    maxLengths = maxLengths or {}
+    encoded = {}
+    for col, col_type in columnTypes.items():
+        if col in df.columns:
+            encoded[col] = _encode_series(df[col], col_type, defaults.get(col), maxLengths.get(col))
         else:
-            return False
-    except requests.RequestException as e:
-        print_log(f"RequestException: {e}")
-        return False
+            encoded[col] = [defaults.get(col)] * len(df)
+    return encoded
+
+def encode_rows(df, columnTypes=None, defaults=None, maxLengths=None):
+    """Tuplas de parámetros (en el orden de columnTypes), una por fila."""
+    return list(zip(*encode_columns(df, columnTypes, defaults, maxLengths).values()))
+
+def encode_records(df):
+    """Filas como dicts con valores nativos (para recorrer un DataFrame tipado)."""
+    encoded = encode_columns(df)
+    return [dict(zip(encoded.keys(), values)) for values in zip(*encoded.values())]
 
 def debug_types(values):
     """Función auxiliar para verificar tipos"""
@@ -209,7 +348,7 @@ def move_file(filePath, success=True):
         return False
     # Si el archivo ya existe en destino, añadir timestamp
     if os.path.exists(dest_path):
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         base, ext = os.path.splitext(file_name)
         file_name = f"{base}_{timestamp}{ext}"
         dest_path = os.path.join(dest_dir, file_name)